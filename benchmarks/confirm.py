@@ -0,0 +1,87 @@
+"""Latency of confirming a multiple rewards' report.
+
+Compares what inline_keyboard_handler used to do (a find_one on `tasks` for
+the CP, then re-building the text) with the catalog lookup it does now.
+Runs against mongomock, or against a real server when DB_URI is set.
+
+Usage: python -m benchmarks.confirm [confirmations] [tasks]
+"""
+import bot_utils
+import catalog
+import config
+import json
+from pymongo import MongoClient
+import statistics
+import sys
+import time
+
+
+def make_database(tasks: int) -> MongoClient:
+    if config.db_uri:
+        database = MongoClient(config.db_uri)['benchmark_confirm']
+    else:
+        import mongomock
+        database = mongomock.MongoClient()['benchmark_confirm']
+
+    database['tasks'].drop()
+    database['tasks'].insert_many([
+        {
+            'English': {'category': f'Category {task % 12}', 'task': f'Task {task}', 'reward': f'Reward{task}'},
+            'cp': 400 + task,
+            'shiny': task % 2 == 0
+        }
+        for task in range(tasks)
+    ])
+    return database
+
+
+def legacy_confirm(database: MongoClient, text: str, reward: str, longitude: float, latitude: float) -> str:
+    # What inline_keyboard_handler used to do
+    rows = text.split('\n')
+    rows[0] = f"<a href='https://www.google.com/maps/search/?api=1&query={latitude},{longitude}'>{rows[0]}</a>"
+    new_row = rows[1].split(',')
+    new_row[0] = f"<b>{reward}</b>"
+    new_row[1] = f"<i>{new_row[1]}</i>"
+    rows[1] = ','.join(new_row)
+
+    new_text_rows = rows[0:2]
+    cp = database['tasks'].find_one({'English.reward': reward.split('✨')[0]}, {'_id': False})['cp']
+    new_text_rows.append(f'💯: {cp}')
+    new_text_rows.append(rows[2])
+    new_text_rows.append('Confirmed by @user')
+    return '\n'.join(new_text_rows)
+
+
+def catalog_confirm(database: MongoClient, text: str, reward: str, longitude: float, latitude: float) -> str:
+    info = bot_utils.get_reward_info(database, reward.split('✨')[0], 'English')
+    return bot_utils.format_confirmed(text, reward, info[0] if info else None, longitude, latitude, 'Confirmed by @user')
+
+
+def measure(function, database: MongoClient, total: int, tasks: int) -> dict:
+    latencies = []
+    for confirmation in range(total):
+        reward = f'Reward{confirmation * 7919 % tasks}'
+        text = f'Pokestop {confirmation}\nUnknown, Task {confirmation}\nReported by @user'
+        start = time.perf_counter()
+        function(database, text, reward, -3.7, 40.4)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return {
+        'confirmations': total,
+        'p50_us': round(statistics.median(latencies) * 1e6, 1),
+        'p99_us': round(latencies[int(total * 0.99) - 1] * 1e6, 1)
+    }
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tasks = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    database = make_database(tasks)
+    catalog.tasks.load(database)
+
+    print(json.dumps({
+        'legacy find_one': measure(legacy_confirm, database, total, tasks),
+        'catalog': measure(catalog_confirm, database, total, tasks)
+    }, indent=4))
@@ -0,0 +1,419 @@
+"""Throughput and latency of the real main.py handlers, offline.
+
+Synthetic updates go through main's Dispatcher and handlers. Bot API calls are
+answered (and counted) by a fake API that never leaves the process. Mongo is
+mongomock (pip install mongomock, it isn't a bot dependency), or a real
+server given with --mongo, whose `benchmark_handlers` database is dropped
+first.
+
+Every phase reports updates/s, per handler latency percentiles and DB
+operations, and Bot API calls per update. --output writes that as a JSON
+baseline. --compare checks a run against one, exiting 1 on regressions.
+DB operations and API calls per update are deterministic. Updates/s are
+only comparable on the same machine, hence the (generous) tolerance.
+
+Usage: python -m benchmarks.handlers [--groups N] [--mongo URI] [--output FILE] [--compare FILE]
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LANGUAGES = ['English', 'Español']
+ADMIN = 42
+# Operations counted on mongomock, a real server is counted by a CommandListener
+OPERATIONS = [
+    'find', 'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+    'delete_one', 'delete_many', 'count_documents', 'aggregate', 'bulk_write', 'distinct'
+]
+
+ops = threading.local()
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========= FAKE API ========= # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+class FakeApi:
+    """Answers Bot API requests in-process, counting them per endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.message_ids = itertools.count(1000000)
+
+    def install(self):
+        # Every Bot instance (updater's and outbox's) is created by main, patch the class
+        import telegram
+        api = self
+
+        def post(bot, endpoint: str, data: dict=None, timeout: float=None, api_kwargs: dict=None):
+            return api.answer(endpoint, data or {})
+
+        telegram.Bot._post = post
+
+    def total(self) -> int:
+        with self.lock:
+            return sum(self.calls.values())
+
+    def answer(self, endpoint: str, data: dict):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            message_id = next(self.message_ids)
+
+        if endpoint == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'benchmark', 'username': 'benchmark'}
+
+        if endpoint == 'getChatAdministrators':
+            return [{'user': {'id': ADMIN, 'is_bot': False, 'first_name': 'admin'}, 'status': 'creator', 'is_anonymous': False}]
+
+        if endpoint in ('sendMessage', 'sendLocation', 'sendVenue', 'editMessageText'):
+            chat_id = int(data['chat_id'])
+            return {
+                'message_id': int(data.get('message_id', message_id)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+                'text': data.get('text', '')
+            }
+
+        return True
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========== MONGO =========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+def count_op():
+    ops.count = getattr(ops, 'count', 0) + 1
+
+
+def count_mongomock():
+    # Only the outermost call counts, mongomock calls itself (find_one -> find...)
+    import mongomock.collection
+
+    def counted(method):
+        def wrapper(*args, **kwargs):
+            ops.depth = getattr(ops, 'depth', 0) + 1
+            if ops.depth == 1:
+                count_op()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                ops.depth -= 1
+        return wrapper
+
+    for name in OPERATIONS:
+        setattr(mongomock.collection.Collection, name, counted(getattr(mongomock.collection.Collection, name)))
+
+
+def make_database(uri: str):
+    if uri is None:
+        import mongomock
+        count_mongomock()
+        return mongomock.MongoClient()['benchmark_handlers']
+
+    from pymongo import MongoClient, monitoring
+
+    class Counter(monitoring.CommandListener):
+        def started(self, event):
+            count_op()
+
+        def succeeded(self, event):
+            pass
+
+        def failed(self, event):
+            pass
+
+    client = MongoClient(uri, event_listeners=[Counter()])
+    client.drop_database('benchmark_handlers')
+    return client['benchmark_handlers']
+
+
+def seed(database, categories: int=6, tasks: int=5):
+    # Every text main.py and bot_utils.py ask for, on every language
+    keys = set()
+    for module in ('main.py', 'bot_utils.py'):
+        with open(os.path.join(ROOT, module), encoding='utf-8') as file:
+            keys.update(re.findall(r"""get_text\([^)]*?['"](\w+)['"]\)""", file.read()))
+
+    database['texts'].insert_many([
+        {'language': language, **{key: f'{key} ({language})' for key in keys}}
+        for language in LANGUAGES
+    ])
+    database['commands'].insert_one({language: f'/help ({language})' for language in LANGUAGES})
+
+    rewards = [f'Reward{number}' for number in range(categories * tasks)]
+    database['tasks'].insert_many([
+        {
+            language: {'category': f'Category {number // tasks}', 'task': f'Task {number}', 'reward': reward}
+            for language in LANGUAGES
+        } | {'cp': 400 + number, 'shiny': number % 3 == 0}
+        for number, reward in enumerate(rewards)
+    ])
+    database['multi_tasks'].insert_many([
+        {
+            language: {'category': f'Category {category}', 'task': f'Multi task {category}', 'reward': rewards[category*tasks:category*tasks + 2]}
+            for language in LANGUAGES
+        } | {'cp': [0, 0], 'shiny': [False, True]}
+        for category in range(categories)
+    ])
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========= UPDATES ========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def chat(chat_id: int) -> dict:
+    return {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'title': 'benchmark'}
+
+
+def user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+
+
+def message(chat_id: int, user_id: int, text: str=None, location: tuple=None) -> dict:
+    payload = {'message_id': next(message_ids), 'date': int(time.time()), 'chat': chat(chat_id), 'from': user(user_id)}
+    if text is not None:
+        payload['text'] = text
+    if location is not None:
+        payload['location'] = {'latitude': location[0], 'longitude': location[1]}
+    return {'update_id': next(update_ids), 'message': payload}
+
+
+def callback(chat_id: int, user_id: int, data: str, text: str) -> dict:
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)),
+            'from': user(user_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {'message_id': next(message_ids), 'date': int(time.time()), 'chat': chat(chat_id), 'text': text}
+        }
+    }
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========= RUNNING ========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+class Recorder:
+    """Wraps main's handlers: latency, DB operations and errors per handler."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Semaphore(0)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = {}
+            self.db_ops = {}
+            self.errors = {}
+
+    def wrap(self, callback):
+        name = callback.__name__
+
+        def wrapper(update, context, *args, **kwargs):
+            ops.count = 0
+            start = time.perf_counter()
+            try:
+                return callback(update, context, *args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.errors[name] = self.errors.get(name, 0) + 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.latencies.setdefault(name, []).append(elapsed)
+                    self.db_ops[name] = self.db_ops.get(name, 0) + ops.count
+                self.done.release()
+
+        wrapper.__name__ = name
+        return wrapper
+
+
+def percentile(values: [float], fraction: float) -> float:
+    return values[max(0, int(len(values) * fraction) - 1)]
+
+
+def run_phase(main, recorder: Recorder, api: FakeApi, updates: [dict], timeout: float=60) -> dict:
+    from telegram import Update
+
+    recorder.reset()
+    calls_before = dict(api.calls)
+    start = time.perf_counter()
+    for payload in updates:
+        main.dp.update_queue.put(Update.de_json(payload, main.dp.bot))
+
+    handled = 0
+    for _ in updates:
+        if not recorder.done.acquire(timeout=timeout):
+            break
+        handled += 1
+    elapsed = time.perf_counter() - start
+
+    # Deletions and other calls submitted without waiting
+    quiet_since, last = time.monotonic(), api.total()
+    while time.monotonic() - quiet_since < 0.1:
+        time.sleep(0.01)
+        if api.total() != last or sum(main.outbox.depth().values()):
+            quiet_since, last = time.monotonic(), api.total()
+
+    calls = {endpoint: count - calls_before.get(endpoint, 0) for endpoint, count in api.calls.items()}
+    calls = {endpoint: count for endpoint, count in sorted(calls.items()) if count}
+    handlers = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        latencies = sorted(latencies)
+        handlers[name] = {
+            'calls': len(latencies),
+            'p50_ms': round(statistics.median(latencies) * 1000, 3),
+            'p90_ms': round(percentile(latencies, 0.9) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'db_ops_per_call': round(recorder.db_ops[name] / len(latencies), 2),
+            'errors': recorder.errors.get(name, 0)
+        }
+
+    return {
+        'updates': len(updates),
+        'unhandled': len(updates) - handled,
+        'updates_per_s': round(handled / elapsed, 1),
+        'api_calls_per_update': round(sum(calls.values()) / len(updates), 2),
+        'api_calls': calls,
+        'handlers': handlers
+    }
+
+
+def scenario(groups: int) -> [(str, [dict])]:
+    # Phases run in order, each one relying on the state left by the previous ones
+    import catalog
+    group_ids = [-1000 - group for group in range(groups)]
+    reporters = [10000 + group for group in range(groups)]
+    locations = [(40 + group / 1000, -3 - group / 1000) for group in range(groups)]
+    categories = [f'Category {group % 6}' for group in range(groups)]
+
+    # Even groups report a single reward, odd ones a multiple one, left to confirm
+    snapshot = catalog.tasks.snapshot
+    buttons = [snapshot.task_buttons[('English', category)] for category in categories]
+    choices = [buttons[group][1 if group % 2 == 0 else 0] for group in range(groups)]
+    rewards = [choice.split(',')[0].split('/')[0].split('✨')[0] for choice in choices]
+
+    return [
+        ('add_group', [message(group_id, ADMIN, '/add_group English 0 GMT+1') for group_id in group_ids]),
+        ('register', [message(user_id, user_id, 'English') for user_id in reporters]),
+        ('private', [message(user_id, user_id, 'hello') for user_id in reporters]),
+        ('location', [message(group_id, user_id, location=location) for group_id, user_id, location in zip(group_ids, reporters, locations)]),
+        ('category', [message(group_id, user_id, category) for group_id, user_id, category in zip(group_ids, reporters, categories)]),
+        ('task', [message(group_id, user_id, choice) for group_id, user_id, choice in zip(group_ids, reporters, choices)]),
+        ('get', [message(group_id, user_id, f'/get {reward}') for group_id, user_id, reward in zip(group_ids, reporters, rewards)]),
+        ('confirm', [
+            callback(group_id, user_id, f'{reward},{location[1]},{location[0]},,{next(message_ids)}', f'Location\nUnknown, Multi task\nReported by @user{user_id}')
+            for group, (group_id, user_id, location, reward) in enumerate(zip(group_ids, reporters, locations, rewards))
+            if group % 2
+        ])
+    ]
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> [str]:
+    regressions = []
+    for phase, old in baseline['phases'].items():
+        new = results['phases'].get(phase)
+        if new is None:
+            regressions.append(f'{phase}: missing')
+            continue
+
+        if new['updates_per_s'] < old['updates_per_s'] * (1 - tolerance):
+            regressions.append(f"{phase}: {new['updates_per_s']} updates/s, baseline {old['updates_per_s']}")
+        if new['api_calls_per_update'] > old['api_calls_per_update']:
+            regressions.append(f"{phase}: {new['api_calls_per_update']} API calls/update, baseline {old['api_calls_per_update']}")
+        for name, handler in new['handlers'].items():
+            reference = old['handlers'].get(name)
+            if reference and handler['db_ops_per_call'] > reference['db_ops_per_call']:
+                regressions.append(f"{phase}/{name}: {handler['db_ops_per_call']} DB ops/call, baseline {reference['db_ops_per_call']}")
+            if handler['errors'] > (reference or {}).get('errors', 0):
+                regressions.append(f"{phase}/{name}: {handler['errors']} errors")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the main.py handlers')
+    parser.add_argument('--groups', type=int, default=300, help='groups (and reporting users) simulated')
+    parser.add_argument('--mongo', help='Mongo URI to use instead of mongomock')
+    parser.add_argument('--output', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline to compare with, exits 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.4, help='allowed updates/s drop against the baseline')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+
+    # main.py builds its bots, rate limits and DB client at import time
+    os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+    os.environ.setdefault('DB_URI', 'mongodb://127.0.0.1:27017')
+    for variable in ('GLOBAL_RATE', 'CHAT_RATE', 'CHAT_BURST'):
+        os.environ[variable] = '1000000'
+
+    # main.py logs to ./logs/log.txt, keep that out of the repo
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix='benchmark_handlers_'))
+    os.makedirs('logs')
+
+    api = FakeApi()
+    api.install()
+
+    import cache
+    import catalog
+    import main
+    import metrics
+
+    main.database = make_database(args.mongo)
+    # Objects main.py built with its own client
+    main.writer.database = main.resets.database = main.database
+    seed(main.database)
+    catalog.texts.load(main.database)
+    catalog.tasks.load(main.database)
+
+    recorder = Recorder()
+    main.register_handlers(main.dp)
+    metrics.instrument(main.dp, recorder.wrap)
+    main.outbox.start()
+    # Same as the Updater does, without polling
+    threading.Thread(target=main.dp.start, name='dispatcher', daemon=True).start()
+
+    results = {
+        'config': {'groups': args.groups, 'mongo': 'mongod' if args.mongo else 'mongomock', 'workers': main.config.workers},
+        'phases': {name: run_phase(main, recorder, api, updates) for name, updates in scenario(args.groups)},
+        'caches': {'groups': cache.groups.stats(), 'users': cache.users.stats(), 'admins': main.admins.stats()}
+    }
+    print(json.dumps(results, indent=4))
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            os._exit(1)
+
+    # Dispatcher and outbox threads aren't daemons
+    os._exit(0)
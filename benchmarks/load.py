@@ -0,0 +1,494 @@
+"""Synthetic report traffic from many groups at once, against a fake Bot API.
+
+The bot runs in-process and unmodified, polling a local HTTP server that
+speaks the Bot API (through BOT_API_URL). Simulated users, spread over N
+groups, run the whole report flow: location, pokestop (on groups that ask
+for it), category, then task. Some also run /get and /delete afterwards.
+They arrive at --rate conversations/s, or all at once with --spike, like
+when research tasks rotate. With --midnight SECONDS, every report expires
+that far into the run, the way the midnight reset does.
+
+Reported per step: end to end latency, from the update being queued to the
+bot's answer reaching the server. Errors count steps the bot answered with
+an error, or did not answer in time. Group handlers that fail behind a
+suppress(Exception) answer "This group isn't registered" without quoting
+anyone: a step left unanswered while one shows up on its group counts as
+that error, and they are also totalled apart. Cross-talk counts conversations that got
+an answer meant for another user or another flow, and /delete calls that
+removed the wrong message.
+
+Users wait --typing seconds before each message. ConversationHandler drops
+updates that arrive while the previous (run_async) handler is still
+running, so --typing 0 shows how often instant answers get lost.
+
+Rate limits are the configured ones (GLOBAL_RATE, CHAT_RATE...), so
+latencies include the outbox's throttling, as they would in production.
+Mongo is mongomock (pip install mongomock) unless --mongo is given.
+
+Usage: python -m benchmarks.load [--groups N] [--users M] [--flows F] [--typing S] [--rate R | --spike] [--midnight SECONDS] [--mongo URI] [--output FILE]
+"""
+import argparse
+from benchmarks.handlers import LANGUAGES, make_database, seed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import types
+from urllib.parse import parse_qs
+
+
+TOKEN = '123456:load'
+BOT = {'id': 123456, 'is_bot': True, 'first_name': 'load', 'username': 'load'}
+# What the seeded texts look like when the bot answers with an error
+ERRORS = ['keyboard (', 'register (', 'unknown_reward (', 'admin (']
+# Sent without quoting anyone when a group handler fails, every group is registered here
+UNREGISTERED = "This group isn't registered"
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ======= FAKE BOT API ======= # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+class FakeTelegram:
+    """Bot API state: pending updates, per chat message ids and what the bot sent."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = {}
+        # chat_id -> [record], every message the bot sent or deleted there
+        self.records = {}
+        self.admins = {}
+        self.calls = {}
+
+    def next_message_id(self, chat_id: int) -> int:
+        # Like Telegram, ids are per chat and shared by users and the bot
+        with self.condition:
+            self.message_ids[chat_id] = self.message_ids.get(chat_id, 0) + 1
+            return self.message_ids[chat_id]
+
+    def push(self, update: dict):
+        with self.condition:
+            update['update_id'] = next(self.update_ids)
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def mark(self, *chat_ids: int) -> dict:
+        with self.condition:
+            return {chat_id: len(self.records.get(chat_id, [])) for chat_id in chat_ids}
+
+    def expect(self, marks: dict, match, timeout: float) -> dict:
+        # First record on those chats, after their marks, that `match` accepts
+        deadline = time.monotonic() + timeout
+        marks = dict(marks)
+        with self.condition:
+            while True:
+                for chat_id, mark in marks.items():
+                    records = self.records.get(chat_id, [])
+                    for record in records[mark:]:
+                        if match(record):
+                            return record
+                    marks[chat_id] = len(records)
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def count(self, match) -> int:
+        with self.condition:
+            return sum(1 for records in self.records.values() for record in records if match(record))
+
+    def get_updates(self, offset: int, limit: int, timeout: float) -> [dict]:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    def record(self, chat_id: int, record: dict):
+        record['chat_id'] = chat_id
+        record['time'] = time.perf_counter()
+        with self.condition:
+            self.records.setdefault(chat_id, []).append(record)
+            self.condition.notify_all()
+
+    def message(self, chat_id: int, data: dict) -> dict:
+        message_id = self.next_message_id(chat_id)
+        markup = data.get('reply_markup')
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+
+        self.record(chat_id, {
+            'method': 'send',
+            'message_id': message_id,
+            'reply_to': int(data['reply_to_message_id']) if data.get('reply_to_message_id') else None,
+            'text': data.get('text', ''),
+            'keyboard': [row[0]['text'] if isinstance(row[0], dict) else row[0] for row in (markup or {}).get('keyboard', [])]
+        })
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'title': 'load'},
+            'from': BOT,
+            'text': data.get('text', '')
+        }
+
+    def answer(self, method: str, data: dict):
+        with self.condition:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == 'getMe':
+            return BOT
+        if method == 'getUpdates':
+            return self.get_updates(int(data.get('offset') or 0), int(data.get('limit') or 100), float(data.get('timeout') or 0))
+        if method in ('sendMessage', 'sendLocation', 'sendVenue'):
+            return self.message(int(data['chat_id']), data)
+        if method == 'editMessageText':
+            return {'message_id': int(data['message_id']), 'date': int(time.time()), 'chat': {'id': int(data['chat_id']), 'type': 'supergroup'}, 'text': data.get('text', '')}
+        if method == 'deleteMessage':
+            self.record(int(data['chat_id']), {'method': 'delete', 'message_id': int(data['message_id'])})
+            return True
+        if method == 'getChatAdministrators':
+            return [
+                {'user': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}, 'status': 'administrator', 'is_anonymous': False}
+                for user_id in self.admins.get(int(data['chat_id']), [])
+            ]
+        return True
+
+
+def make_handler(telegram: FakeTelegram):
+    class ApiHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Delayed ACKs would add ~40ms to every call otherwise
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            method = self.path.rsplit('/', 1)[-1]
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                data = json.loads(body or b'{}')
+            else:
+                data = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+            payload = json.dumps({'ok': True, 'result': telegram.answer(method, data)}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST
+
+        def log_message(self, format: str, *args):
+            pass
+
+    return ApiHandler
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========== USERS =========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.outcomes = {}
+        self.flows = {'started': 0, 'completed': 0, 'crosstalk': 0, 'failed': 0}
+        # (step, first line of the answer) -> times, for errors and cross-talk
+        self.answers = {}
+
+    def step(self, step: str, outcome: str, latency: float=None, text: str=None):
+        with self.lock:
+            self.outcomes.setdefault(step, {}).setdefault(outcome, 0)
+            self.outcomes[step][outcome] += 1
+            if latency is not None:
+                self.latencies.setdefault(step, []).append(latency)
+            if text is not None:
+                key = f'{step}: {text.splitlines()[0] if text else text}'
+                self.answers[key] = self.answers.get(key, 0) + 1
+
+    def flow(self, outcome: str):
+        with self.lock:
+            self.flows[outcome] += 1
+
+    def summary(self) -> dict:
+        steps = {}
+        for step, outcomes in self.outcomes.items():
+            latencies = sorted(self.latencies.get(step, [])) or [0]
+            total = sum(outcomes.values())
+            steps[step] = {
+                'sent': total,
+                'outcomes': outcomes,
+                'error_rate': round(1 - outcomes.get('ok', 0) / total, 4),
+                'p50_ms': round(statistics.median(latencies) * 1000, 1),
+                'p95_ms': round(latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000, 1),
+                'p99_ms': round(latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000, 1)
+            }
+
+        sent = sum(step['sent'] for step in steps.values())
+        failed = sum(step['sent'] - step['outcomes'].get('ok', 0) for step in steps.values())
+        flows = {**self.flows, 'broken': self.flows['crosstalk'] + self.flows['failed']}
+        return {'flows': flows, 'error_rate': round(failed / sent, 4) if sent else 0, 'steps': steps, 'unexpected_answers': self.answers}
+
+
+class User(threading.Thread):
+    """Runs `flows` report conversations on its group, one after the other."""
+
+    def __init__(self, telegram: FakeTelegram, results: Results, user_id: int, group_id: int, pokestop: bool, start: float, args):
+        super().__init__(name=f'user{user_id}', daemon=True)
+        self.telegram = telegram
+        self.results = results
+        self.user_id = user_id
+        self.group_id = group_id
+        self.pokestop = pokestop
+        self.start_at = start
+        self.args = args
+        self.random = random.Random(user_id)
+
+    def send(self, chat_id: int, text: str=None, location: tuple=None, reply_to: int=None) -> (int, dict, float):
+        time.sleep(self.args.typing)
+        message_id = self.telegram.next_message_id(chat_id)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'title': 'load'},
+            'from': {'id': self.user_id, 'is_bot': False, 'first_name': f'user{self.user_id}', 'username': f'user{self.user_id}'}
+        }
+        if text is not None:
+            message['text'] = text
+        if location is not None:
+            message['location'] = {'latitude': location[0], 'longitude': location[1]}
+        if reply_to is not None:
+            message['reply_to_message'] = {'message_id': reply_to, 'date': int(time.time()), 'chat': message['chat'], 'from': BOT}
+
+        # The user's private chat too, for answers sent there
+        mark = self.telegram.mark(chat_id, self.user_id)
+        sent = time.perf_counter()
+        self.telegram.push({'message': message})
+        return message_id, mark, sent
+
+    def reply(self, step: str, message_id: int, mark: dict, sent: float, check, match=None) -> dict:
+        # The bot quotes group messages it answers, anything else there is someone else's
+        def answer(record: dict) -> bool:
+            if record['method'] != 'send':
+                return False
+            if record['chat_id'] == self.group_id and record['reply_to'] == message_id:
+                return True
+            return match is not None and match(record)
+
+        record = self.telegram.expect(mark, answer, self.args.timeout)
+        if record is None:
+            # A handler that failed quietly quotes no one, but it broke this step all the same
+            record = self.telegram.expect(mark, lambda record: record['method'] == 'send' and record['chat_id'] == self.group_id and record['text'].startswith(UNREGISTERED), 0)
+        return self.classify(step, record, sent, check)
+
+    def classify(self, step: str, record: dict, sent: float, check) -> dict:
+        if record is None:
+            self.results.step(step, 'timeout')
+            return None
+
+        latency = record['time'] - sent
+        if any(error in record['text'] for error in ERRORS) or record['text'].startswith(UNREGISTERED):
+            self.results.step(step, 'error', latency, record['text'])
+            return None
+
+        if not check(record):
+            self.results.step(step, 'crosstalk', latency, record['text'])
+            record['crosstalk'] = True
+            return record
+
+        self.results.step(step, 'ok', latency)
+        return record
+
+    def run(self):
+        time.sleep(max(0, self.start_at - time.perf_counter()))
+        for flow in range(self.args.flows):
+            self.results.flow('started')
+            outcome = self.report(flow)
+            self.results.flow(outcome)
+            time.sleep(self.random.uniform(0, self.args.think))
+
+    def report(self, flow: int) -> str:
+        import catalog
+        snapshot = catalog.tasks.snapshot
+        language = LANGUAGES[0]
+        location = (40 + self.random.random(), -3 - self.random.random())
+
+        message_id, mark, sent = self.send(self.group_id, location=location)
+        expected = 'pokestop (' if self.pokestop else 'category ('
+        record = self.reply('location', message_id, mark, sent, lambda record: record['text'].startswith(expected))
+        if record is None or record.get('crosstalk'):
+            return 'crosstalk' if record else 'failed'
+
+        pokestop = ''
+        if self.pokestop:
+            pokestop = f'Stop {self.user_id}-{flow}'
+            message_id, mark, sent = self.send(self.group_id, pokestop)
+            record = self.reply('pokestop', message_id, mark, sent, lambda record: record['text'].startswith('category ('))
+            if record is None or record.get('crosstalk'):
+                return 'crosstalk' if record else 'failed'
+
+        category = self.random.choice(snapshot.categories[language])
+        buttons = snapshot.task_buttons[(language, category)]
+        message_id, mark, sent = self.send(self.group_id, category)
+        record = self.reply('category', message_id, mark, sent, lambda record: record['keyboard'] == buttons)
+        if record is None or record.get('crosstalk'):
+            return 'crosstalk' if record else 'failed'
+
+        # Single reward tasks only, multiple ones wait for someone to confirm them
+        choice = self.random.choice([button for button in buttons if '\n' in button])
+        reward = choice.split(',')[0].split('✨')[0]
+        username = f'@user{self.user_id}'
+        message_id, mark, sent = self.send(self.group_id, choice)
+        # The report itself quotes nothing, it names who sent it
+        record = self.reply('task', message_id, mark, sent,
+            lambda record: reward in record['text'] and pokestop in record['text'],
+            lambda record: record['chat_id'] == self.group_id and username in record['text']
+        )
+        if record is None or record.get('crosstalk'):
+            return 'crosstalk' if record else 'failed'
+        report_id = record['message_id']
+
+        if self.random.random() < self.args.get:
+            message_id, mark, sent = self.send(self.group_id, f'/get {reward}')
+            # Reports go to the user's private chat, 'no reports' is answered on the group
+            record = self.reply('get', message_id, mark, sent,
+                lambda record: record['text'].startswith((f'{reward} (', 'no_reports (')),
+                lambda record: record['chat_id'] == self.user_id
+            )
+            if record is None or record.get('crosstalk'):
+                return 'crosstalk' if record else 'failed'
+
+        if self.random.random() < self.args.delete:
+            message_id, mark, sent = self.send(self.group_id, '/delete', reply_to=report_id)
+            record = self.reply('delete', message_id, mark, sent, lambda record: record['text'] == '✅')
+            if record is None or record.get('crosstalk'):
+                return 'crosstalk' if record else 'failed'
+
+            # The report the user replied to has to be the one removed. Deletions are bulk work, they may take a while
+            deleted = self.telegram.expect(mark, lambda record: record['method'] == 'delete' and record['message_id'] == report_id, self.args.timeout)
+            if deleted is None:
+                self.results.step('delete_target', 'crosstalk')
+                return 'crosstalk'
+            self.results.step('delete_target', 'ok')
+
+        return 'completed'
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========== SETUP =========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+def start_bot(telegram: FakeTelegram, mongo: str):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(telegram))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-api', daemon=True).start()
+
+    # main.py builds its bots and DB client at import time
+    os.environ['BOT_TOKEN'] = TOKEN
+    os.environ['BOT_API_URL'] = f'http://127.0.0.1:{server.server_port}/bot'
+    os.environ.setdefault('DB_URI', 'mongodb://127.0.0.1:27017')
+
+    import catalog
+    import main
+    import metrics
+
+    main.database = make_database(mongo)
+    main.writer.database = main.resets.database = main.database
+    seed(main.database)
+    catalog.texts.load(main.database)
+    catalog.tasks.load(main.database)
+
+    main.register_handlers(main.dp)
+    metrics.instrument(main.dp)
+    main.outbox.start()
+    main.deleter.start(main.updater.job_queue)
+    main.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=main.allowed_updates)
+    return main
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Multi-group load against a fake Bot API')
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--users', type=int, default=200, help='spread evenly over the groups')
+    parser.add_argument('--flows', type=int, default=3, help='report conversations per user')
+    parser.add_argument('--rate', type=float, default=20, help='users starting per second')
+    parser.add_argument('--spike', action='store_true', help='every user starts at once')
+    parser.add_argument('--typing', type=float, default=0.5, help='seconds before each message, 0 races the conversation states')
+    parser.add_argument('--think', type=float, default=1, help='max seconds between a user\'s flows')
+    parser.add_argument('--get', type=float, default=0.3, help='chance of a /get after reporting')
+    parser.add_argument('--delete', type=float, default=0.2, help='chance of a /delete after reporting')
+    parser.add_argument('--midnight', type=float, help='expire every report this many seconds in')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for each answer')
+    parser.add_argument('--mongo', help='Mongo URI to use instead of mongomock')
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    # main.py logs to ./logs/log.txt, keep that out of the repo
+    os.chdir(tempfile.mkdtemp(prefix='benchmark_load_'))
+    os.makedirs('logs')
+
+    telegram = FakeTelegram()
+    main = start_bot(telegram, args.mongo)
+    import bot_utils
+    import metrics
+
+    # Groups and users are set up beforehand, half the groups ask for pokestops
+    group_ids = [-2000 - group for group in range(args.groups)]
+    for group, group_id in enumerate(group_ids):
+        bot_utils.create_group(main.database, group_id, LANGUAGES[0], group % 2 == 1, 'GMT+1', False)
+    user_ids = [20000 + user for user in range(args.users)]
+    for user_id in user_ids:
+        bot_utils.create_user(main.database, user_id, LANGUAGES[0])
+    for user, user_id in enumerate(user_ids):
+        telegram.admins.setdefault(group_ids[user % args.groups], []).append(user_id)
+
+    results = Results()
+    start = time.perf_counter() + 0.5
+    users = [
+        User(telegram, results, user_id, group_ids[user % args.groups], user % args.groups % 2 == 1, start if args.spike else start + user / args.rate, args)
+        for user, user_id in enumerate(user_ids)
+    ]
+    for user in users:
+        user.start()
+
+    midnight = None
+    if args.midnight is not None:
+        # Every group is on GMT+1, its reset is every report
+        context = types.SimpleNamespace(job=types.SimpleNamespace(context='GMT+1'))
+        midnight = threading.Timer(start - time.perf_counter() + args.midnight, main.resets.reset, args=(context,))
+        midnight.start()
+
+    for user in users:
+        user.join()
+    elapsed = time.perf_counter() - start
+    if midnight:
+        midnight.join()
+
+    summary = results.summary()
+    summary['config'] = {key: value for key, value in vars(args).items() if key != 'output'}
+    summary['seconds'] = round(elapsed, 1)
+    summary['handler_errors'] = dict((labels[0], value) for labels, value in metrics.handler_errors.values.items())
+    # Handlers that failed inside a suppress(Exception), nobody can tell whose update it was
+    summary['unregistered_replies'] = telegram.count(lambda record: record['method'] == 'send' and record['text'].startswith(UNREGISTERED))
+    summary['api_calls'] = telegram.calls
+    if args.midnight is not None:
+        summary['midnight'] = {key: value for key, value in main.resets.last.get('GMT+1', {}).items() if key != 'finished'}
+    print(json.dumps(summary, indent=4, default=str))
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(summary, file, indent=4, default=str)
+
+    # Updater, dispatcher and outbox threads aren't daemons
+    os._exit(0)
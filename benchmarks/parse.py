@@ -0,0 +1,117 @@
+"""Parse time and peak memory of the research page parser.
+
+Runs against saved copies of https://thesilphroad.com/research-tasks given
+as arguments. Without them, it runs the hand-written markup fixtures in
+benchmarks/fixtures and a synthetic page with the same structure. Those
+check the parsers agree on markup variants (eg: .cp divs inside a
+.cpWrap), their timings say little about the real page. The full-page
+html.parser approach scrap.py used before is measured too, as a
+reference, and both must return the same tasks.
+
+Usage: python -m benchmarks.parse [page.html ...]
+"""
+from bs4 import BeautifulSoup
+import json
+import os
+from pokedex import Pokedex
+import re
+import research
+import sys
+import time
+import tracemalloc
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def synthetic_page(categories: int=12, tasks: int=8, rewards: int=3, noise: int=2000) -> str:
+    groups = []
+    for category in range(categories):
+        taskDivs = []
+        for task in range(tasks):
+            rewardDivs = ''.join(
+                f'<div class="task-reward pokemon{" shinyAvailable" if reward % 2 else ""}">'
+                f'<img src="https://assets.thesilphroad.com/img/pokemon/icons/96x96/{1 + (category*tasks + task + reward) % 900}.png">'
+                f'<div class="cp"><p>Min</p><p>{400 + reward}</p></div>'
+                f'<div class="cp"><p>Max</p><p>1,{100 + reward}</p></div>'
+                '</div>'
+                for reward in range(1 + task % rewards)
+            )
+            taskDivs.append(
+                '<div class="task unconfirmed pkmn">'
+                f'<p class="taskText">Catch {task} pokémon of category {category}.</p>'
+                f'<div class="taskRewardsWrap">{rewardDivs}</div>'
+                '</div>'
+            )
+        groups.append(f'<div class="taskGroupWrap"><h3>Category {category} Tasks</h3>{"".join(taskDivs)}</div>')
+
+    # Navigation, ads, scripts... everything the scraper doesn't need
+    filler = ''.join(f'<div class="noise"><a href="/{i}">link {i}</a><p>{"text " * 10}</p></div>' for i in range(noise))
+    return f'<html><head><title>Research</title></head><body>{filler}<div id="taskGroupWraps">{"".join(groups)}</div>{filler}</body></html>'
+
+
+def legacy_parse(html: str, dex: Pokedex) -> [tuple]:
+    # What scrap.py used to do, kept as a reference
+    soup = BeautifulSoup(html, 'html.parser')
+    divWrapper = soup.find('div', {'id':'taskGroupWraps'})
+    scraped = []
+    for groupDiv in divWrapper.find_all('div', recursive=False):
+        category = groupDiv.find_all()[0]
+        category = ' '.join(category.text.split(' ')[:-1])
+        for taskDiv in groupDiv.find_all('div', {'class' : re.compile('.*task unconfirmed pkmn.*')}, recursive=False):
+            task = taskDiv.find('p', {'class': 'taskText'}).text[:-1]
+            wrapper = taskDiv.find('div', {'class': 'taskRewardsWrap'})
+            rewardsDiv = wrapper.find_all('div', {'class' : re.compile('.*task-reward pokemon.*')}, recursive=False)
+            if(len(rewardsDiv) == 0):
+                continue
+            cps = [int(div.find_all('div', class_='cp')[1].find_all('p')[1].text.replace(",","")) for div in rewardsDiv]
+            rewards = [dex.reward(div.find('img')['src'].split('/')[-1].split('.')[0]) for div in rewardsDiv]
+            shinys = ['shinyAvailable' in div['class'] for div in rewardsDiv]
+            scraped.append((category.capitalize(), task.capitalize(), cps, rewards, shinys))
+
+    return scraped
+
+
+def measure(function, repeat: int=5) -> (float, int, list):
+    # Best wall time out of `repeat` runs, peak traced memory of one run
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def backends() -> [str]:
+    available = ['html.parser']
+    try:
+        import lxml
+        available.append('lxml')
+    except ImportError:
+        pass
+    return available
+
+
+if __name__ == '__main__':
+    dex = Pokedex()
+    paths = sys.argv[1:] or sorted(os.path.join(FIXTURES, name) for name in os.listdir(FIXTURES) if name.endswith('.html'))
+    pages = {path: open(path, encoding='utf-8').read() for path in paths}
+    if not sys.argv[1:]:
+        pages['synthetic'] = synthetic_page()
+
+    results = {}
+    for name, html in pages.items():
+        seconds, peak, expected = measure(lambda: legacy_parse(html, dex))
+        results[name] = {'legacy html.parser': {'ms': round(seconds * 1000, 2), 'peak_kb': peak // 1024}}
+
+        for features in backends():
+            seconds, peak, scraped = measure(lambda: research.parse_tasks(research.find_wrapper(html, features), dex))
+            if scraped != expected:
+                sys.exit(f'{name}: {features} parse differs from the legacy one')
+            results[name][features] = {'ms': round(seconds * 1000, 2), 'peak_kb': peak // 1024, 'tasks': len(scraped)}
+
+    print(json.dumps(results, indent=4))
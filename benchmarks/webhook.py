@@ -0,0 +1,152 @@
+"""Webhook vs long polling latency, measured locally.
+
+Synthetic updates are delivered to a real Updater/Dispatcher either through
+a fake `getUpdates` (polling) or POSTed to the Updater's webhook server, and
+the time until the handler runs is recorded.
+
+Usage: python -m benchmarks.webhook [updates] [clients]
+"""
+import config
+import json
+from queue import Empty, Queue
+import socket
+import statistics
+import sys
+from telegram import Bot, Update, User
+from telegram.ext import Filters, MessageHandler, Updater
+from telegram.utils.request import Request
+import threading
+import time
+import urllib.request
+
+
+class FakeBot(Bot):
+    """Bot whose API calls never leave the process."""
+
+    def __init__(self):
+        super().__init__('123456:benchmark', request=Request(con_pool_size=config.workers + 4))
+        self.pending = Queue()
+
+    def get_me(self, *args, **kwargs) -> User:
+        return User(123456, 'benchmark', True, username='benchmark')
+
+    def set_webhook(self, *args, **kwargs) -> bool:
+        return True
+
+    def delete_webhook(self, *args, **kwargs) -> bool:
+        return True
+
+    def get_updates(self, offset: int=None, limit: int=100, timeout: float=0, **kwargs) -> [Update]:
+        # Long polling: block until there's something to return
+        try:
+            updates = [self.pending.get(timeout=max(timeout, 0.1))]
+        except Empty:
+            return []
+
+        while len(updates) < limit:
+            try:
+                updates.append(self.pending.get_nowait())
+            except Empty:
+                break
+
+        return [Update.de_json(update, self) for update in updates]
+
+
+def make_update(update_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': -1000 - update_id % 50, 'type': 'supergroup', 'title': 'benchmark'},
+            'from': {'id': update_id % 500, 'is_bot': False, 'first_name': 'user'},
+            'text': str(time.perf_counter())
+        }
+    }
+
+
+def start_updater(bot: FakeBot, latencies: [float], done: threading.Event, total: int) -> Updater:
+    def record(update, context):
+        latencies.append(time.perf_counter() - float(update.message.text))
+        if len(latencies) >= total:
+            done.set()
+
+    updater = Updater(bot=bot, workers=config.workers)
+    updater.dispatcher.add_handler(MessageHandler(Filters.text, record, run_async=True))
+    return updater
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_polling(total: int) -> [float]:
+    bot = FakeBot()
+    latencies = []
+    done = threading.Event()
+    updater = start_updater(bot, latencies, done, total)
+    updater.start_polling(poll_interval=0, timeout=1)
+
+    for update_id in range(1, total + 1):
+        bot.pending.put(make_update(update_id))
+    done.wait(60)
+
+    updater.stop()
+    return latencies
+
+
+def run_webhook(total: int, clients: int) -> [float]:
+    bot = FakeBot()
+    latencies = []
+    done = threading.Event()
+    updater = start_updater(bot, latencies, done, total)
+    port = free_port()
+    updater.start_webhook(
+        listen='127.0.0.1',
+        port=port,
+        url_path='benchmark',
+        webhook_url=f'http://127.0.0.1:{port}/benchmark',
+        max_connections=config.webhook_connections
+    )
+    time.sleep(0.5)
+
+    def post(update_ids: range):
+        for update_id in update_ids:
+            request = urllib.request.Request(
+                f'http://127.0.0.1:{port}/benchmark',
+                data=json.dumps(make_update(update_id)).encode(),
+                headers={'Content-Type': 'application/json'}
+            )
+            urllib.request.urlopen(request).read()
+
+    threads = [
+        threading.Thread(target=post, args=(range(1 + client, total + 1, clients),))
+        for client in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    done.wait(60)
+
+    updater.stop()
+    return latencies
+
+
+def summary(latencies: [float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'updates': len(latencies),
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3)
+    }
+
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    print(json.dumps({
+        'polling': summary(run_polling(total)),
+        'webhook': summary(run_webhook(total, clients))
+    }, indent=4))
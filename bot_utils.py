@@ -1,11 +1,20 @@
+import cache
+import catalog
 import config
 from contextlib import suppress
-from datetime import datetime
+from datetime import datetime, time as daytime
+import heapq
+import html
+import itertools
+import logging
+import outbound
 import pymongo
 from pymongo import MongoClient
+import pytz
 import telegram
 import telegram.ext
 from telegram import *
+import threading
 import time
 import typing
 from typing import Any, Union
@@ -14,18 +23,37 @@ from typing import Any, Union
 Cursor = typing.NewType('Cursor', pymongo.cursor.Cursor)
 Timezone = typing.NewType('Timezone', str)
 
+logger = logging.getLogger(__name__)
+
 
 # # # # # # # # # # # # ============================ # # # # # # # # # # # #
 # # # # # # # # # # # # ============ DB ============ # # # # # # # # # # # #
 # # # # # # # # # # # # ============================ # # # # # # # # # # # #
 
 def create_user(database: MongoClient, user_id: int, language: str='English', admin: bool=False):
-    database['users'].insert_one({
-            'user_id': int(user_id),
-            'language': language,
-            'admin': admin,
-            'reports': 0
-    })
+    # Upsert, the user may have registered already through another replica
+    database['users'].update_one(
+        {'user_id': int(user_id)},
+        {
+            '$set': {'language': language},
+            '$setOnInsert': {'admin': admin, 'reports': 0}
+        },
+        upsert=True
+    )
+    cache.users.invalidate(user_id)
+
+
+def set_language(database: MongoClient, user_id: int, language: str):
+    database['users'].update_one(
+        {'user_id': int(user_id)},
+        {'$set': {'language': language}}
+    )
+    cache.users.invalidate(user_id)
+
+
+def get_language(database: MongoClient, user_id: int) -> Union[str, None]:
+    # None if the user isn't registered
+    return cache.users.get(database, user_id)
 
 
 def set_admin(database: MongoClient, user_id: int, value: bool=False):
@@ -35,60 +63,50 @@ def set_admin(database: MongoClient, user_id: int, value: bool=False):
     )
 
 
-def save_task(database: MongoClient, group_id: int, message_id: int, user_id: int, location_id: int, longitude: float, latitude: float, reward: str, pokestop: str):
+def save_task(database: MongoClient, group_id: int, message_id: int, user_id: int, location_id: int, longitude: float, latitude: float, reward: str, pokestop: str, writer: 'WriteBehind'=None):
     # Get group's timezone
-    timezone = get_attr(
-        database,
-        group_id,
-        'timezone',
-        'groups'
-    )
+    timezone = get_group(database, group_id).timezone
 
     # Save task info
+    report = {
+        'group_id': group_id,
+        'message_id': message_id,
+        'location_id': location_id,
+        'longitude': float(longitude),
+        'latitude': float(latitude),
+        'reward': reward,
+        'timezone': timezone
+    }
     if pokestop:
-        database['reports'].insert_one({
-                'group_id': group_id,
-                'message_id': message_id,
-                'location_id': location_id,
-                'longitude': longitude,
-                'latitude': latitude,
-                'reward': reward,
-                'timezone': timezone,
-                'pokestop': pokestop
-        })
+        report['pokestop'] = pokestop
 
-    else:
-         database['reports'].insert_one({
-                'group_id': group_id,
-                'message_id': message_id,
-                'location_id': location_id,
-                'longitude': longitude,
-                'latitude': latitude,
-                'reward': reward,
-                'timezone': timezone
-        })
+    # GeoJSON point for /near, out of range coordinates would be rejected by the 2dsphere index
+    if -180 <= report['longitude'] <= 180 and -90 <= report['latitude'] <= 90:
+        report['location'] = {
+            'type': 'Point',
+            'coordinates': [report['longitude'], report['latitude']]
+        }
+
+    if writer is None:
+        database['reports'].insert_one(report)
+        database['users'].update_one(
+            {'user_id': int(user_id)},
+            {'$inc': {'reports': 1}}
+        )
+        return
+
+    writer.insert(report)
 
     # Add 1 to user's reports
-    database['users'].update_one(
-        {'user_id': int(user_id)},
-        {'$inc': {'reports': 1}}
-    )
+    writer.count('users', 'user_id', int(user_id))
 
     # # Add 1 to reward's counter
-    # database['reports_counter'].update_one(
-    #     {'pokemon': reward},
-    #     {'$inc': {'reports': 1}}
-    # )
+    # writer.count('reports_counter', 'pokemon', reward)
 
 
 def save_unconfirmed(database: MongoClient, group_id: int, message_id: int, location_id: int):
     # Get group's timezone
-    timezone = get_attr(
-        database,
-        group_id,
-        'timezone',
-        'groups'
-    )
+    timezone = get_group(database, group_id).timezone
 
     database['reports'].insert_one({
         'group_id': group_id,
@@ -99,7 +117,7 @@ def save_unconfirmed(database: MongoClient, group_id: int, message_id: int, loca
     })      
     
 
-def read_reports(database: MongoClient, group_id: int, reward: str) -> Cursor:
+def read_reports(database: MongoClient, group_id: int, reward: str, skip: int=0, limit: int=0) -> Cursor:
     return database['reports'].find({
             'group_id': group_id,
             'reward': reward
@@ -107,29 +125,53 @@ def read_reports(database: MongoClient, group_id: int, reward: str) -> Cursor:
         {
             '_id': False,
         }
-    )
+    ).sort('_id', 1).skip(skip).limit(limit)
+
+
+def near_reports(database: MongoClient, group_id: int, reward: str, longitude: float, latitude: float, radius: float, limit: int) -> [dict]:
+    # Closest first, radius in km, 'distance' in meters
+    return list(database['reports'].aggregate([
+        {
+            '$geoNear': {
+                'near': {'type': 'Point', 'coordinates': [longitude, latitude]},
+                'distanceField': 'distance',
+                'maxDistance': radius*1000,
+                'query': {'group_id': group_id, 'reward': reward},
+                'key': 'location',
+                'spherical': True
+            }
+        },
+        {'$limit': limit},
+        {'$project': {'_id': False}}
+    ]))
+
+
+def count_reports(database: MongoClient, group_id: int, reward: str) -> int:
+    return database['reports'].count_documents({
+        'group_id': group_id,
+        'reward': reward
+    })
     
 
-def delete_report(database: MongoClient, bot: Bot, delete_id: int, group_id: int):
-    report = database['reports'].find({'group_id': group_id, 'message_id': delete_id}, {'_id': False})
-    if report.count() == 0:
+def delete_report(database: MongoClient, outbox: outbound.Outbox, delete_id: int, group_id: int) -> bool:
+    # Returns whether `delete_id` was a report (or its location)
+    report = database['reports'].find_one({'group_id': group_id, 'message_id': delete_id}, {'_id': False})
+    if report is None:
         report = database['reports'].find_one({'group_id': group_id, 'location_id': delete_id}, {'_id': False})
-    else:
-        report = report.next()
-
-    with suppress(Exception):
-        # Delete bot message
-        bot.delete_message(
-            chat_id=group_id,
-            message_id=report['message_id'],
-        )
+    if report is None:
+        return False
 
-    with suppress(Exception):
-        # Delete location
-        bot.delete_message(
-            chat_id=group_id,
-            message_id=report['location_id']
-        )
+    # Delete bot message
+    outbox.submit('delete_message', outbound.BULK,
+        chat_id=group_id,
+        message_id=report['message_id'],
+    )
+
+    # Delete location
+    outbox.submit('delete_message', outbound.BULK,
+        chat_id=group_id,
+        message_id=report['location_id']
+    )
 
     # Delete report
     database['reports'].delete_many(
@@ -145,53 +187,58 @@ def delete_report(database: MongoClient, bot: Bot, delete_id: int, group_id: int
             'location_id': delete_id
         }
     )
-
-
-def delete_reports(database: MongoClient, timezone: Timezone, bot: Bot):
-    messages = database['reports'].find({'timezone': timezone})
-    for message in messages:
-        with suppress(Exception):
-            # Delete bot message
-            bot.delete_message(
-                chat_id=message['group_id'],
-                message_id=message['message_id']
-            )
-
-        with suppress(Exception):
-            # Delete location
-            bot.delete_message(
-                chat_id=message['group_id'],
-                message_id=message['location_id']
-            )
+    return True
+
+
+def delete_reports(database: MongoClient, timezone: Timezone, outbox: outbound.Outbox, deleter: 'DeleteQueue') -> int:
+    # Queued as bulk work, so interactive replies go first. Returns how many messages were deleted
+    # Only the reports read now are purged, the ones saved meanwhile keep their messages
+    messages = list(database['reports'].find(
+        {'timezone': timezone},
+        {'_id': True, 'group_id': True, 'message_id': True, 'location_id': True}
+    ))
+    database['reports'].delete_many({'_id': {'$in': [message['_id'] for message in messages]}})
+
+    deletions = [
+        outbox.submit('delete_message', outbound.BULK,
+            chat_id=message['group_id'],
+            message_id=message[key]
+        )
+        for message in messages
+        for key in ['message_id', 'location_id'] if key in message
+    ]
     
-    # Send warnings
-    sent = [] 
-    for id in messages.distinct('group_id'):
-        message = bot.send_message(
+    # Send warnings, deleted a few seconds later
+    warnings = [
+        outbox.submit('send_message', outbound.BULK,
             text='⏰💥',
             chat_id=id,
             reply_markup=ReplyKeyboardRemove()
         )
-        sent.append(message)
-
-    # Delete warnings    
-    time.sleep(5)
-    for message in sent:
+        for id in {message['group_id'] for message in messages}
+    ]
+    for warning in warnings:
         with suppress(Exception):
-            bot.delete_message(
-                chat_id=message.chat_id,
-                message_id=message.message_id
-            )
+            message = warning.result()
+            deleter.schedule(message.chat_id, [message.message_id], 5)
 
-    # Delete reports
-    database['reports'].delete_many({'timezone': timezone})
+    return sum(1 for deletion in deletions if deletion.exception() is None)
 
 
 def delete_event(database: MongoClient):
     database['tasks'].delete_many({'event': True})
     database['multi_tasks'].delete_many({'event': True})
+
+    catalog.bump_version(database, 'tasks', 'multi_tasks')
+    catalog.tasks.load(database)
     
 
+def reload_texts(database: MongoClient):
+    # texts and commands are edited by hand, let every running bot know
+    catalog.bump_version(database, 'texts', 'commands')
+    catalog.texts.load(database)
+
+
 def create_group(database: MongoClient, group_id: int, language: str, pokestop: bool, timezone: Timezone, confirmation: bool):
     if(timezone[:3] == 'GMT'):
         database['groups'].insert_one({
@@ -201,6 +248,7 @@ def create_group(database: MongoClient, group_id: int, language: str, pokestop:
             'timezone': timezone,
             'confirmation' : confirmation
         })
+        group_changed(database, group_id)
         return
 
     raise Exception(f"'{timezone}' isn't a valid timezone")
@@ -218,113 +266,94 @@ def edit_group(database: MongoClient, group_id: int, language: str, pokestop: bo
             }
         }
     )
+    group_changed(database, group_id)
 
 
-def get_attr(database: MongoClient, id: int, attribute: str='language', collection: str='users') -> Any:
-    key = collection[:-1] + '_id'
-    results = list(
-        database[collection].find(
-            {
-                key: int(id)
-            },
-            {
-                '_id': False,
-                attribute: True
-            }
-        )
-    )
-    length = len(results)
+def get_group(database: MongoClient, group_id: int) -> Union[cache.Group, None]:
+    # Every setting on a single (cached) read, None if the group isn't registered
+    return cache.groups.get(database, group_id)
 
-    if(length == 0):
-        raise Exception(f"'{key}'={id} not found on {collection}")
-        return
 
-    if(length > 1):
-        raise Exception(f"'{key}'={id} wasn't unique on {collection}")
-        return
-        
-    return results[0][attribute]
+def group_changed(database: MongoClient, group_id: int):
+    # Drop it here, and let other processes know through the version stamp
+    cache.groups.invalidate(group_id)
+    catalog.bump_version(database, 'groups')
 
 
 def get_languages(database: MongoClient) -> [str]:    
-    return list(database['texts'].find({}, {'_id': False}).distinct('language'))
+    return catalog.texts.get_languages(database)
 
 
 def get_categories(database: MongoClient, language: str) -> [str]:
-    return database['tasks'].find(
-        {},
-        {
-            '_id': False,
-            f'{language}.category': True
-        }
-    ).distinct(f'{language}.category')
+    return catalog.tasks.get(database).categories.get(language, [])
+
+
+def is_category(database: MongoClient, category: str, language: str) -> bool:
+    return category in catalog.tasks.get(database).category_sets.get(language, ())
 
 
 def get_available_rewards(database: MongoClient, language: str='English') -> [str]:
-    return database['tasks'].find(
-            {},
-            {
-                '_id': False,
-                f'{language}.reward': True
-            }
-    ).distinct(f'{language}.reward')
-
-
-def get_tasks(database: MongoClient, category: str, language: str='English') -> [dict]:
-    tasks = database['tasks'].find(
-            {
-                f'{language}.category': category
-            },
-            {
-                '_id': False,
-                f'{language}.task': True,
-                f'{language}.reward': True,
-                'cp': True,
-                'shiny': True
-            }
-    )
-    multiples = database['multi_tasks'].find(
-            {
-                f'{language}.category': category
-            },
-            {
-                '_id': False,
-                f'{language}.task': True,
-                f'{language}.reward': True,
-                'cp': True,
-                'shiny': True
-            }
-    )
-    array = []
-    for task in multiples:
-        text = ""
-        for i in range(len(task[language]['reward'])):
-            text += f"{task[language]['reward'][i] + ('✨' if task['shiny'][i]==True else '')}/"
-        text = text[:-1]
-        text += f", {task[language]['task']}"
-        array.append(text)
-    array.extend([f"{task[language]['reward'] + ('✨' if task['shiny']==True else '')}, {task[language]['task']}\n💯: {task['cp']}" for task in tasks]) 
-    array.append("❌❌❌")
-    return array
+    return catalog.tasks.get(database).rewards.get(language, [])
+
+
+def is_reward(database: MongoClient, reward: str, language: str='English') -> bool:
+    return reward in catalog.tasks.get(database).reward_sets.get(language, ())
+
+
+def get_reward_info(database: MongoClient, reward: str, language: str='English') -> Union[tuple, None]:
+    # (cp, shiny), None if no task gives that reward
+    return catalog.tasks.get(database).reward_info.get(language, {}).get(reward)
+
+
+def get_tasks(database: MongoClient, category: str, language: str='English') -> [str]:
+    return catalog.tasks.get(database).task_buttons.get((language, category), ['❌❌❌'])
+
+
+def get_task_keyboard(database: MongoClient, category: str, language: str='English') -> ReplyKeyboardMarkup:
+    # Pre-rendered when the catalog loads
+    keyboard = catalog.tasks.get(database).task_keyboards.get((language, category))
+    return keyboard or array_to_keyboard(get_tasks(database, category, language))
 
 
 def get_text(database: MongoClient, language: str, text:str) -> str:
-    return database['texts'].find_one(
-        {'language': language},
-        {
-            '_id': False,
-            text : True
-        }
-        )[text]
+    return catalog.texts.get_text(database, language, text)
 
 
 def get_commands(database: MongoClient, language: str) -> [str]:
-    for dictionary in database['commands'].find({},{'_id': False}):
-        for key, value in dictionary.items():
-            if key == language:
-                return value
-        
-    return "Error loading commands"
+    return catalog.texts.get_commands(database, language)
+
+
+def format_reports(reports: [dict], location_text: str, coordinates: bool=False, start: int=0) -> str:
+    rows = []
+    for number, report in enumerate(reports, start + 1):
+        link = f"https://www.google.com/maps/search/?api=1&query={report['latitude']},{report['longitude']}"
+        distance = f" ({report['distance']/1000:.1f} km)" if 'distance' in report else ''
+        rows.append(f"{number}. <a href='{link}'>{html.escape(report.get('pokestop') or location_text)}</a>{distance}")
+        if coordinates:
+            rows.append(f"<code>{report['latitude']}, {report['longitude']}</code>")
+
+    return '\n'.join(rows)
+
+
+def format_confirmed(text: str, reward: str, cp: Union[int, None], longitude: float, latitude: float, confirmed_text: str) -> str:
+    # `text` is the plain text of the unconfirmed report: location, 'unknown, task' and who reported it
+    location, task, reporter = text.split('\n', 2)
+    task = task.partition(',')[2]
+    rows = [
+        f"<a href='https://www.google.com/maps/search/?api=1&query={latitude},{longitude}'>{html.escape(location)}</a>",
+        f"<b>{html.escape(reward)}</b>,<i>{html.escape(task)}</i>"
+    ]
+    if cp is not None:
+        rows.append(f'💯: {cp}')
+    rows.append(html.escape(reporter))
+    rows.append(confirmed_text)
+    return '\n'.join(rows)
+
+
+def get_page_button(group_id: int, reward: str, page: int, mode: str) -> InlineKeyboardMarkup:
+    # Reward goes last, so it can be split off as-is
+    keyboard = [[InlineKeyboardButton('➡️', callback_data=f'page,{group_id},{page},{mode},{reward}')]]
+    return InlineKeyboardMarkup(keyboard)
 
 
 def get_private_button(database: MongoClient, language: str) -> InlineKeyboardMarkup:
@@ -334,20 +363,201 @@ def get_private_button(database: MongoClient, language: str) -> InlineKeyboardMa
 
 
 # # # # # # # # # # # # ============================ # # # # # # # # # # # #
-# # # # # # # # # # # # ============ ANY =========== # # # # # # # # # # # #
+# # # # # # # # # # # # =========== JOBS =========== # # # # # # # # # # # #
 # # # # # # # # # # # # ============================ # # # # # # # # # # # #
 
+class DeleteQueue:
+    """Deletes messages after a delay, without holding a dispatcher worker.
+
+    Handlers `schedule` deletions and return right away, a repeating job on
+    the updater's JobQueue deletes whatever expired, grouped per chat.
+    """
+
+    def __init__(self, outbox: outbound.Outbox, interval: float=1):
+        self.outbox = outbox
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def start(self, job_queue: telegram.ext.JobQueue):
+        job_queue.run_repeating(self.flush, interval=self.interval, first=self.interval)
+
+    def schedule(self, chat_id: int, message_ids: [int], delay: float):
+        due = time.monotonic() + delay
+        with self.lock:
+            heapq.heappush(self.pending, (due, next(self.counter), chat_id, list(message_ids)))
+
+    def flush(self, context: telegram.ext.CallbackContext=None):
+        now = time.monotonic()
+        expired = {}
+        with self.lock:
+            while self.pending and self.pending[0][0] <= now:
+                _, _, chat_id, message_ids = heapq.heappop(self.pending)
+                expired.setdefault(chat_id, {}).update(dict.fromkeys(message_ids))
+
+        for chat_id, message_ids in expired.items():
+            for message_id in message_ids:
+                self.outbox.submit('delete_message', outbound.BULK,
+                    chat_id=chat_id,
+                    message_id=message_id
+                )
+
+
+class WriteBehind:
+    """Buffers `$inc` counters in memory and writes them with one bulk_write.
+
+    Counters are flushed every `interval` seconds (and on shutdown) or as soon
+    as `threshold` different documents are pending. Failed writes go back to
+    the buffer, so increments are only lost if the process dies.
+
+    With `batch_reports`, report inserts are group-committed: whoever finds
+    no insert running writes everything queued so far with an ordered
+    insert_many, bursts end up in a few round trips instead of one each.
+    """
+
+    def __init__(self, database: MongoClient, interval: float=config.flush_interval, threshold: int=config.flush_threshold, batch_reports: bool=config.batch_reports):
+        self.database = database
+        self.interval = interval
+        self.threshold = threshold
+        self.batch_reports = batch_reports
+        self.lock = threading.Lock()
+        self.inserting = threading.Lock()
+        # (collection, key, value) -> increment
+        self.counters = {}
+        self.reports = []
+
+    def __len__(self) -> int:
+        return len(self.counters) + len(self.reports)
+
+    def start(self, job_queue: telegram.ext.JobQueue):
+        job_queue.run_repeating(self.flush, interval=self.interval, first=self.interval)
+
+    def count(self, collection: str, key: str, value: Any, amount: int=1):
+        with self.lock:
+            field = (collection, key, value)
+            self.counters[field] = self.counters.get(field, 0) + amount
+            full = len(self.counters) >= self.threshold
+
+        if full:
+            self.flush_counters()
+
+    def insert(self, report: dict):
+        if not self.batch_reports:
+            self.database['reports'].insert_one(report)
+            return
+
+        with self.lock:
+            self.reports.append(report)
+        self.flush_reports(wait=False)
+
+    def flush(self, context: telegram.ext.CallbackContext=None):
+        # Reports first, so counters never get ahead of them
+        self.flush_reports()
+        self.flush_counters()
+
+    def flush_reports(self, wait: bool=True):
+        while self.inserting.acquire(blocking=wait):
+            try:
+                with self.lock:
+                    batch, self.reports = self.reports, []
+                if batch:
+                    self.database['reports'].insert_many(batch, ordered=True)
+
+            except pymongo.errors.BulkWriteError as error:
+                # Ordered: everything before the failing report was written, retry what's after it
+                failed = error.details['nInserted']
+                logger.warning(f'Dropping report {batch[failed]}: "{error.details["writeErrors"][0]["errmsg"]}"')
+                with self.lock:
+                    self.reports[:0] = batch[failed + 1:]
+
+            except Exception as error:
+                logger.warning(f'Inserting {len(batch)} reports failed, will retry: "{error}"')
+                with self.lock:
+                    self.reports[:0] = batch
+                return
+
+            finally:
+                self.inserting.release()
+
+            # Reports queued while this batch was written would be left behind otherwise
+            with self.lock:
+                if not self.reports:
+                    return
+
+    def flush_counters(self):
+        with self.lock:
+            counters, self.counters = self.counters, {}
+        if not counters:
+            return
+
+        fields = list(counters)
+        requests = {}
+        for field in fields:
+            collection, key, value = field
+            requests.setdefault(collection, []).append(
+                pymongo.UpdateOne({key: value}, {'$inc': {'reports': counters[field]}})
+            )
+
+        failed = []
+        for collection, updates in requests.items():
+            pending = [field for field in fields if field[0] == collection]
+            try:
+                self.database[collection].bulk_write(updates, ordered=False)
+            except pymongo.errors.BulkWriteError as error:
+                # Per document errors won't go away by retrying
+                for write in error.details['writeErrors']:
+                    logger.warning(f'Dropping {pending[write["index"]]} increment: "{write["errmsg"]}"')
+            except Exception as error:
+                logger.warning(f'Flushing {len(updates)} counters on {collection} failed, will retry: "{error}"')
+                failed.extend(pending)
+
+        # Put them back, adding up with whatever was counted meanwhile
+        with self.lock:
+            for field in failed:
+                self.counters[field] = self.counters.get(field, 0) + counters[field]
+
+
+class MidnightResets:
+    """One daily job per timezone, purging its reports at local midnight."""
+
+    def __init__(self, database: MongoClient, outbox: outbound.Outbox, deleter: DeleteQueue):
+        self.database = database
+        self.outbox = outbox
+        self.deleter = deleter
+        self.last = {}
+
+    def start(self, job_queue: telegram.ext.JobQueue):
+        for timezone in get_timezones():
+            offset = int(timezone[3:])
+            job_queue.run_daily(
+                self.reset,
+                time=daytime(hour=-offset % 24, tzinfo=pytz.utc),
+                context=timezone,
+                name=f'reset {timezone}'
+            )
+
+    def reset(self, context: telegram.ext.CallbackContext):
+        # Runs on the JobQueue's thread, dispatcher workers are not involved
+        timezone = context.job.context
+        start = time.monotonic()
+        deleted = delete_reports(self.database, timezone, self.outbox, self.deleter)
+        duration = time.monotonic() - start
+
+        self.last[timezone] = {
+            'finished': datetime.utcnow(),
+            'duration': duration,
+            'deleted': deleted
+        }
+        logger.info(f'Midnight reset for {timezone} deleted {deleted} messages in {duration:.1f}s')
 
-def get_midnight() -> Timezone:
-    now = datetime.utcnow()
-    if (now.minute < 55 and now.minute > 5):
-        return False 
 
-    tz = 24-now.hour
-    if(tz > 14):
-        tz -= 24
-        
-    return f'GMT+{tz}' if tz > 0 else f'GMT{tz}'
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ============ ANY =========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
 
 
 def get_timezones() -> [Timezone]:
@@ -365,7 +575,7 @@ def array_to_keyboard(array: [str], selective: bool=True) -> ReplyKeyboardMarkup
     )
 
 
-def delete_keyboard(database: MongoClient, bot: Bot):
+def delete_keyboard(database: MongoClient, outbox: outbound.Outbox):
     groups = database['groups'].find(
         {},
         {
@@ -375,13 +585,13 @@ def delete_keyboard(database: MongoClient, bot: Bot):
     )
 
     for group in groups:
-        sent = bot.send_message(
+        sent = outbox.call('send_message', outbound.BULK,
             text="Deleting keyboards...",
             chat_id=group['group_id'],
             reply_markup=ReplyKeyboardRemove()
         )
 
-        bot.delete_message(
+        outbox.submit('delete_message', outbound.BULK,
             chat_id=group['group_id'],
             message_id=sent.message_id
         )
@@ -0,0 +1,209 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import config
+import logging
+from pymongo import MongoClient
+import threading
+import time
+import typing
+from typing import Union
+
+
+logger = logging.getLogger(__name__)
+
+
+class Group(typing.NamedTuple):
+    group_id: int
+    language: str
+    pokestop: bool
+    timezone: str
+    confirmation: bool
+
+
+class GroupCache:
+    """Group documents, fetched once and kept until the group is edited."""
+
+    collections = ['groups']
+
+    def __init__(self):
+        self.groups = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, database: MongoClient, group_id: int) -> Union[Group, None]:
+        # Unregistered groups are cached too (as None), /add_group invalidates them
+        group_id = int(group_id)
+        if group_id in self.groups:
+            self.hits += 1
+            return self.groups[group_id]
+
+        self.misses += 1
+        document = database['groups'].find_one({'group_id': group_id}, {'_id': False})
+        group = None
+        if document is not None:
+            group = Group(
+                group_id=group_id,
+                language=document['language'],
+                pokestop=bool(document.get('pokestop')),
+                timezone=document['timezone'],
+                confirmation=bool(document.get('confirmation'))
+            )
+
+        self.groups[group_id] = group
+        return group
+
+    def invalidate(self, group_id: int):
+        self.groups.pop(int(group_id), None)
+
+    def clear(self, database: MongoClient=None):
+        # Watcher callback, another process edited some group
+        self.groups = {}
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0
+        }
+
+
+class UserCache:
+    """user_id -> language, least recently used entries are evicted first.
+
+    Entries expire after `ttl` seconds, so changes made by other processes are
+    eventually seen. Unregistered users expire after `negative_ttl`, as they
+    are the ones likely to change. `users` is written on every report, so it
+    isn't watched.
+    """
+
+    def __init__(self, size: int=config.user_cache_size, ttl: float=config.user_cache_ttl, negative_ttl: float=config.user_cache_negative_ttl):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, database: MongoClient, user_id: int) -> Union[str, None]:
+        # Unregistered users are cached too (as None) for a while, create_user invalidates them
+        user_id = int(user_id)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is not None and entry[1] > now:
+                self.users.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        document = database['users'].find_one({'user_id': user_id}, {'_id': False, 'language': True})
+        language = document['language'] if document else None
+
+        with self.lock:
+            self.users[user_id] = (language, now + (self.ttl if language is not None else self.negative_ttl))
+            self.users.move_to_end(user_id)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+                self.evictions += 1
+
+        return language
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            self.users.pop(int(user_id), None)
+
+    def clear(self, database: MongoClient=None):
+        with self.lock:
+            self.users = OrderedDict()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.users),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0
+        }
+
+
+class AdminCache:
+    """chat_id -> ids of its administrators, from `get_chat_administrators`.
+
+    Entries expire after `ttl` seconds. ChatMember updates trigger a refresh
+    on the background, at most `refreshes` of them running at once.
+    """
+
+    def __init__(self, outbox, ttl: float=config.admin_cache_ttl, refreshes: int=config.admin_refreshes):
+        self.outbox = outbox
+        self.ttl = ttl
+        self.chats = {}
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=refreshes, thread_name_prefix='admins')
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def fetch(self, chat_id: int) -> frozenset:
+        members = self.outbox.call('get_chat_administrators', chat_id=chat_id)
+        admins = frozenset(member.user.id for member in members)
+        with self.lock:
+            self.chats[chat_id] = (admins, time.monotonic() + self.ttl)
+        return admins
+
+    def is_admin(self, chat_id: int, user_id: int) -> bool:
+        with self.lock:
+            entry = self.chats.get(chat_id)
+            fresh = entry is not None and entry[1] > time.monotonic()
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        admins = entry[0] if fresh else self.fetch(chat_id)
+        return user_id in admins
+
+    def refresh(self, chat_id: int):
+        # Stale entry is dropped right away, several updates for the same chat only queue one refresh
+        with self.lock:
+            self.chats.pop(chat_id, None)
+            if chat_id in self.pending:
+                return
+            self.pending.add(chat_id)
+
+        self.executor.submit(self.run_refresh, chat_id)
+
+    def run_refresh(self, chat_id: int):
+        with self.lock:
+            self.pending.discard(chat_id)
+
+        try:
+            self.fetch(chat_id)
+            self.refreshes += 1
+        except Exception as error:
+            # Next check will fetch it again
+            logger.warning(f'Refreshing admins of {chat_id} failed: "{error}"')
+            with self.lock:
+                self.chats.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'chats': len(self.chats),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'hit_rate': self.hits / total if total else 0
+        }
+
+
+groups = GroupCache()
+users = UserCache()
+
+
+if __name__ == '__main__':
+    print("You shouldn't be executing this")
@@ -0,0 +1,288 @@
+import config
+from contextlib import suppress
+import logging
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from telegram import ReplyKeyboardMarkup
+import threading
+import time
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========= VERSIONS ========= # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+def bump_version(database: MongoClient, *collections: str):
+    # Version stamps let the watcher notice changes without a change stream
+    for collection in collections:
+        database['versions'].update_one(
+            {'collection': collection},
+            {'$inc': {'version': 1}},
+            upsert=True
+        )
+
+
+class Watcher(threading.Thread):
+    """Calls the subscribed callbacks whenever one of their collections changes.
+
+    Uses a change stream when the server supports it (replica sets) and falls
+    back to polling the version stamps written by `bump_version` otherwise.
+    """
+
+    def __init__(self, database: MongoClient, interval: float=config.catalog_refresh):
+        super().__init__(name='catalog-watcher', daemon=True)
+        self.database = database
+        self.interval = interval
+        self.callbacks = {}
+        # collection -> last version stamp seen, a missing stamp is version 0
+        self.versions = {}
+
+    def subscribe(self, collections: [str], callback: Callable[[MongoClient], None]):
+        for collection in collections:
+            self.callbacks.setdefault(collection, []).append(callback)
+
+    def notify(self, collections: [str]):
+        callbacks = []
+        for collection in collections:
+            for callback in self.callbacks.get(collection, []):
+                if callback not in callbacks:
+                    callbacks.append(callback)
+
+        # A bad document mustn't kill the thread, the last good snapshot stays in use
+        for callback in callbacks:
+            try:
+                callback(self.database)
+            except Exception as error:
+                logger.warning(f'Reloading catalog after change on {collections} failed: {type(error).__name__} "{error}"')
+
+    def baseline(self):
+        # Taken before the first load, so any bump after it counts as a change
+        try:
+            for stamp in self.database['versions'].find({'collection': {'$in': list(self.callbacks)}}, {'_id': False}):
+                self.versions[stamp['collection']] = stamp['version']
+        except PyMongoError as error:
+            logger.warning(f'Reading version stamps failed: "{error}"')
+
+    def run(self):
+        try:
+            self.watch_changes()
+        except PyMongoError as error:
+            logger.info(f'Change streams unavailable ("{error}"), polling version stamps instead')
+            self.poll_versions()
+
+    def watch_changes(self):
+        pipeline = [{'$match': {'$or': [
+            {'ns.coll': {'$in': list(self.callbacks)}},
+            {'to.coll': {'$in': list(self.callbacks)}}
+        ]}}]
+        with self.database.watch(pipeline, max_await_time_ms=500) as stream:
+            # Coalesce bursts (eg: scrap.py inserting every task) into a single reload
+            pending = set()
+            while stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    for namespace in ('ns', 'to'):
+                        collection = change.get(namespace, {}).get('coll')
+                        if collection in self.callbacks:
+                            pending.add(collection)
+                    continue
+
+                if pending:
+                    self.notify(pending)
+                    pending = set()
+
+    def poll_versions(self):
+        while True:
+            with_changes = []
+            try:
+                for stamp in self.database['versions'].find({'collection': {'$in': list(self.callbacks)}}, {'_id': False}):
+                    if self.versions.get(stamp['collection'], 0) != stamp['version']:
+                        with_changes.append(stamp['collection'])
+                    self.versions[stamp['collection']] = stamp['version']
+            except PyMongoError as error:
+                logger.warning(f'Polling version stamps failed: "{error}"')
+
+            if with_changes:
+                self.notify(with_changes)
+
+            time.sleep(self.interval)
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # =========== TEXTS ========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+class TextCatalog:
+    """Every document on `texts` and `commands`, kept in memory.
+
+    Edits made straight on the DB aren't seen until their version is bumped,
+    use /reload_texts (or bot_utils.reload_texts) after changing them.
+    """
+
+    collections = ['texts', 'commands']
+
+    def __init__(self):
+        self.texts = None
+        self.commands = None
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, database: MongoClient):
+        texts = {
+            document['language']: document
+            for document in database['texts'].find({}, {'_id': False})
+        }
+        commands = {}
+        for document in database['commands'].find({}, {'_id': False}):
+            for key, value in document.items():
+                commands.setdefault(key, value)
+
+        # Rebinding is atomic, readers never see a half-built catalog
+        self.texts, self.commands = texts, commands
+
+    def ensure_loaded(self, database: MongoClient):
+        if self.texts is None:
+            self.misses += 1
+            self.load(database)
+            return
+
+        self.hits += 1
+
+    def get_text(self, database: MongoClient, language: str, text: str) -> str:
+        if self.texts is not None:
+            with suppress(KeyError):
+                value = self.texts[language][text]
+                self.hits += 1
+                return value
+
+        # Unknown languages (like False, for unregistered groups) won't be fixed by reloading
+        if self.texts is not None and language not in self.texts:
+            raise KeyError(language)
+
+        # Not loaded yet, or text was added after the last reload
+        self.misses += 1
+        self.load(database)
+        return self.texts[language][text]
+
+    def get_commands(self, database: MongoClient, language: str) -> [str]:
+        self.ensure_loaded(database)
+        return self.commands.get(language, "Error loading commands")
+
+    def get_languages(self, database: MongoClient) -> [str]:
+        self.ensure_loaded(database)
+        return sorted(self.texts)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0
+        }
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # =========== TASKS ========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+def render_task(task: dict, language: str) -> str:
+    values = task[language]
+    return f"{values['reward'] + ('✨' if task['shiny']==True else '')}, {values['task']}\n💯: {task['cp']}"
+
+
+def render_multi_task(task: dict, language: str) -> str:
+    values = task[language]
+    rewards = '/'.join(reward + ('✨' if shiny==True else '') for reward, shiny in zip(values['reward'], task['shiny']))
+    return f"{rewards}, {values['task']}"
+
+
+class TaskSnapshot:
+    """Immutable view of `tasks` and `multi_tasks`, indexed per language."""
+
+    def __init__(self, tasks: [dict], multi_tasks: [dict]):
+        self.tasks = tasks
+        self.multi_tasks = multi_tasks
+
+        rewards = {}
+        categories = {}
+        buttons = {}
+        reward_info = {}
+        # Multiple rewards' tasks go first, as get_tasks used to do
+        for task in multi_tasks:
+            for language, values in task.items():
+                if isinstance(values, dict):
+                    buttons.setdefault((language, values['category']), []).append(render_multi_task(task, language))
+
+        for task in tasks:
+            for language, values in task.items():
+                if not isinstance(values, dict):
+                    continue
+
+                rewards.setdefault(language, set()).add(values['reward'])
+                categories.setdefault(language, set()).add(values['category'])
+                buttons.setdefault((language, values['category']), []).append(render_task(task, language))
+                # First task giving the reward wins, like find_one would
+                reward_info.setdefault(language, {}).setdefault(values['reward'], (task['cp'], task['shiny']))
+
+        # Sets for membership checks, sorted lists (like distinct) for replies
+        self.reward_sets = rewards
+        self.category_sets = categories
+        self.rewards = {language: sorted(values) for language, values in rewards.items()}
+        self.categories = {language: sorted(values) for language, values in categories.items()}
+        # reward -> (cp, shiny), for confirming multiple rewards' reports
+        self.reward_info = reward_info
+
+        # Reply keyboard for every (language, category), ready to be sent
+        self.task_buttons = {key: values + ['❌❌❌'] for key, values in buttons.items()}
+        self.task_keyboards = {
+            key: ReplyKeyboardMarkup([[button] for button in values], one_time_keyboard=True, selective=True)
+            for key, values in self.task_buttons.items()
+        }
+
+
+class TaskCatalog:
+    """Latest `TaskSnapshot`, rebuilt and swapped whenever the tasks change."""
+
+    collections = ['tasks', 'multi_tasks']
+
+    def __init__(self):
+        self.snapshot = None
+
+    def load(self, database: MongoClient):
+        self.snapshot = TaskSnapshot(
+            list(database['tasks'].find({}, {'_id': False})),
+            list(database['multi_tasks'].find({}, {'_id': False}))
+        )
+
+    def get(self, database: MongoClient) -> TaskSnapshot:
+        if self.snapshot is None:
+            self.load(database)
+
+        return self.snapshot
+
+
+texts = TextCatalog()
+tasks = TaskCatalog()
+
+
+def watch(database: MongoClient, *caches) -> Watcher:
+    watcher = Watcher(database)
+    watcher.subscribe(texts.collections, texts.load)
+    watcher.subscribe(tasks.collections, tasks.load)
+    # Lazy caches (see cache.py) are just dropped, they refill on demand
+    for lazy in caches:
+        watcher.subscribe(lazy.collections, lazy.clear)
+
+    watcher.baseline()
+    texts.load(database)
+    tasks.load(database)
+    watcher.start()
+    return watcher
+
+
+if __name__ == '__main__':
+    print("You shouldn't be executing this")
@@ -9,3 +9,52 @@ db_auth = os.getenv("DB_AUTH")
 
 token    = os.getenv("BOT_TOKEN")
 username = os.getenv("BOT_USERNAME")
+# Local Bot API server (or a fake one, see benchmarks/load.py), Telegram's by default
+api_url  = os.getenv("BOT_API_URL")
+
+catalog_refresh = int(os.getenv("CATALOG_REFRESH", 60))
+
+workers = int(os.getenv("WORKERS", 8))
+
+global_rate  = float(os.getenv("GLOBAL_RATE", 30))
+chat_rate    = float(os.getenv("CHAT_RATE", 1))
+chat_burst   = float(os.getenv("CHAT_BURST", 5))
+send_retries = int(os.getenv("SEND_RETRIES", 5))
+send_workers = int(os.getenv("SEND_WORKERS", 8))
+
+page_size = int(os.getenv("PAGE_SIZE", 10))
+
+user_cache_size = int(os.getenv("USER_CACHE_SIZE", 100000))
+user_cache_ttl  = float(os.getenv("USER_CACHE_TTL", 3600))
+# Unregistered users, kept short: they may register through another replica
+user_cache_negative_ttl = float(os.getenv("USER_CACHE_NEGATIVE_TTL", 30))
+
+admin_cache_ttl = float(os.getenv("ADMIN_CACHE_TTL", 600))
+admin_refreshes = int(os.getenv("ADMIN_REFRESHES", 2))
+
+flush_interval  = float(os.getenv("FLUSH_INTERVAL", 5))
+flush_threshold = int(os.getenv("FLUSH_THRESHOLD", 500))
+batch_reports   = os.getenv("BATCH_REPORTS", "0") == "1"
+
+metrics_listen = os.getenv("METRICS_LISTEN", "127.0.0.1")
+metrics_port   = int(os.getenv("METRICS_PORT", 9100))
+
+profile_queries = os.getenv("PROFILE_QUERIES", "0") == "1"
+query_budget    = int(os.getenv("QUERY_BUDGET", 0))
+
+pool_size = int(os.getenv("POOL_SIZE", send_workers + 4))
+
+# Report conversations (ConversationHandler states, chat_data) live in each process.
+# Several webhook replicas need the load balancer to send every update of a chat
+# to the same one (eg: hashing the chat id), or reports break halfway
+webhook_url         = os.getenv("WEBHOOK_URL")
+webhook_listen      = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+webhook_port        = int(os.getenv("WEBHOOK_PORT", 8443))
+webhook_path        = os.getenv("WEBHOOK_PATH", "telegram")
+webhook_secret      = os.getenv("WEBHOOK_SECRET", "")
+webhook_connections = int(os.getenv("WEBHOOK_CONNECTIONS", 40))
+
+dex_path  = os.getenv("DEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pokedex.json"))
+dex_cache = os.getenv("DEX_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pokedex_cache.json"))
+
+translations_file = os.getenv("TRANSLATIONS_FILE")
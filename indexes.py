@@ -0,0 +1,162 @@
+import catalog
+import config
+import logging
+from pymongo import ASCENDING, GEOSPHERE, MongoClient
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+# collection: [(keys, options)]
+INDEXES = {
+    'reports': [
+        ([('group_id', ASCENDING), ('reward', ASCENDING), ('_id', ASCENDING)], {}),
+        ([('group_id', ASCENDING), ('message_id', ASCENDING)], {}),
+        ([('group_id', ASCENDING), ('location_id', ASCENDING)], {}),
+        ([('timezone', ASCENDING)], {}),
+        ([('group_id', ASCENDING), ('reward', ASCENDING), ('location', GEOSPHERE)], {})
+    ],
+    'users': [
+        ([('user_id', ASCENDING)], {'unique': True})
+    ],
+    'groups': [
+        ([('group_id', ASCENDING)], {'unique': True})
+    ],
+    'texts': [
+        ([('language', ASCENDING)], {'unique': True})
+    ],
+    'translations': [
+        ([('text', ASCENDING)], {})
+    ],
+    'versions': [
+        ([('collection', ASCENDING)], {'unique': True})
+    ],
+    'tasks': [
+        ([('event', ASCENDING)], {})
+    ],
+    'multi_tasks': [
+        ([('event', ASCENDING)], {})
+    ]
+}
+
+# Queries the bot runs on every update, (collection, filter, sort)
+HOT_QUERIES = [
+    ('reports', {'group_id': -1, 'reward': 'Dratini'}, [('_id', ASCENDING)]),
+    ('reports', {'group_id': -1, 'message_id': 1}, None),
+    ('reports', {'group_id': -1, 'location_id': 1}, None),
+    ('reports', {'timezone': 'GMT+1'}, None),
+    ('reports', {'group_id': -1, 'reward': 'Dratini', 'location': {'$nearSphere': {'$geometry': {'type': 'Point', 'coordinates': [0, 0]}, '$maxDistance': 1000}}}, None),
+    ('users', {'user_id': 1}, None),
+    ('groups', {'group_id': -1}, None),
+    ('tasks', {'event': True}, None),
+    ('multi_tasks', {'event': True}, None)
+]
+
+
+def required_indexes(database: MongoClient) -> dict:
+    # Tasks are filtered by category on each language's subdocument
+    required = {collection: list(indexes) for collection, indexes in INDEXES.items()}
+    for language in catalog.texts.get_languages(database):
+        for collection in ['tasks', 'multi_tasks']:
+            required[collection].append(([(f'{language}.category', ASCENDING)], {}))
+
+    return required
+
+
+def index_name(keys: [tuple]) -> str:
+    # Same naming scheme MongoDB uses by default
+    return '_'.join(f'{key}_{direction}' for key, direction in keys)
+
+
+def create_indexes(collection: Collection, indexes: [tuple]):
+    # create_index is a no-op for indexes that already exist
+    for keys, options in indexes:
+        try:
+            collection.create_index(keys, **options)
+        except OperationFailure as error:
+            logger.warning(f'Could not create index {index_name(keys)} on {collection.name}: "{error}"')
+
+
+def ensure_indexes(database: MongoClient):
+    required = required_indexes(database)
+    for collection, indexes in required.items():
+        create_indexes(database[collection], indexes)
+
+    audit_indexes(database, required)
+
+
+def audit_indexes(database: MongoClient, required: dict):
+    for collection, indexes in required.items():
+        expected = {index_name(keys) for keys, _ in indexes}
+        existing = {}
+        try:
+            for stats in database[collection].aggregate([{'$indexStats': {}}]):
+                existing[stats['name']] = stats['accesses']['ops']
+        except OperationFailure as error:
+            logger.warning(f'Could not read index stats for {collection}: "{error}"')
+            continue
+
+        for name in expected - set(existing):
+            logger.warning(f'Missing index {name} on {collection}')
+
+        for name, ops in existing.items():
+            if name not in expected and name != '_id_':
+                logger.warning(f'Index {name} on {collection} is not declared (used {ops} times since restart)')
+
+
+def get_stages(plan: dict) -> [str]:
+    stages = [plan['stage']] if 'stage' in plan else []
+    for key in ['inputStage', 'queryPlan']:
+        if key in plan:
+            stages.extend(get_stages(plan[key]))
+    for child in plan.get('inputStages', []):
+        stages.extend(get_stages(child))
+
+    return stages
+
+
+def check_plans(database: MongoClient) -> [str]:
+    # Returns the hot queries that aren't covered by an index
+    problems = []
+    queries = HOT_QUERIES + [
+        (collection, {f'{language}.category': 'Catch'}, None)
+        for language in catalog.texts.get_languages(database)
+        for collection in ['tasks', 'multi_tasks']
+    ]
+    for collection, query, sort in queries:
+        cursor = database[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        stages = get_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        if 'COLLSCAN' in stages or 'SORT' in stages:
+            problems.append(f'{collection} {query}: {" <- ".join(stages)}')
+
+    return problems
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    if config.db_uri:
+        client = MongoClient(config.db_uri, serverSelectionTimeoutMS=5000)
+    else:
+        client = MongoClient(
+            config.db_ip,
+            username=config.db_user,
+            password=config.db_pass,
+            authSource=config.db_auth
+        )
+    database = client['bot']
+
+    ensure_indexes(database)
+    problems = check_plans(database)
+    for problem in problems:
+        print(f'Not covered by an index: {problem}')
+
+    if problems:
+        sys.exit(1)
+
+    print('Every hot query uses an index')
@@ -1,8 +1,14 @@
 import bot_utils
+import cache
+import catalog
 import config
 from contextlib import suppress
 from datetime import datetime
+import indexes
 import logging
+import math
+import metrics
+import outbound
 from pymongo import MongoClient
 import telegram
 from telegram.ext import *
@@ -21,23 +27,32 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 token = config.token 
-updater = Updater(token)
+updater = Updater(token, base_url=config.api_url, workers=config.workers, request_kwargs={'con_pool_size': config.workers + 4})
 dp = updater.dispatcher
-bot = telegram.Bot(token)
+# Outbox workers share this bot, give them a connection each
+bot = telegram.Bot(token, base_url=config.api_url, request=telegram.utils.request.Request(con_pool_size=config.pool_size))
+outbox = outbound.Outbox(bot)
 
 if config.db_uri:
-    client = MongoClient(config.db_uri, serverSelectionTimeoutMS=5000)
+    client = MongoClient(config.db_uri, serverSelectionTimeoutMS=5000, event_listeners=[metrics.MongoListener()])
 else:
     client = MongoClient(
         config.db_ip,
         username=config.db_user,
         password=config.db_pass,
-        authSource=config.db_auth
+        authSource=config.db_auth,
+        event_listeners=[metrics.MongoListener()]
     )
 database = client['bot']
 
 sleep = 5 
 parse_mode = "HTML"
+deleter = bot_utils.DeleteQueue(outbox)
+resets = bot_utils.MidnightResets(database, outbox, deleter)
+admins = cache.AdminCache(outbox)
+writer = bot_utils.WriteBehind(database)
+# chat_member isn't sent by Telegram unless asked for, admins' cache needs it
+allowed_updates = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
 
 
 class my_location:
@@ -48,44 +63,55 @@ class my_location:
         self.longitude = longitude
 
 
+def reply(update: Update, text: str, wait: bool=True, **kwargs) -> Message:
+    # Same as Message.reply_text, but through the outbound queue. Without `wait`, the worker doesn't block on it
+    if update.effective_chat.type != Chat.PRIVATE:
+        kwargs.setdefault('reply_to_message_id', update.message.message_id)
+
+    send = outbox.call if wait else outbox.submit
+    return send('send_message',
+        chat_id=update.message.chat_id,
+        text=text,
+        **kwargs
+    )
+
+
 def check_user(update: Update, context: CallbackContext) -> [int, Union[bool, str]]:
     try:
         user_id = int(update.message.from_user.id)
     except Exception:
         user_id = int(update.callback_query.from_user.id)
 
-    with suppress(Exception):
-        return user_id, bot_utils.get_attr(database, user_id)
-
-    return user_id, False
+    return user_id, bot_utils.get_language(database, user_id) or False
 
 
 def check_admin(update: Update, context: CallbackContext, user_id: int) -> bool:
-    member = bot.get_chat_member(
-        chat_id=update.effective_chat.id,
-        user_id=update.message.from_user.id
-    )
-    status = member.status
-    if (status == "creator" or status == "administrator"): 
-        return True
+    return admins.is_admin(update.effective_chat.id, user_id)
 
-    return False
+
+def chat_member_changed(update: Update, context: CallbackContext):
+    # Only promotions/demotions matter to the admins' cache
+    change = update.chat_member
+    statuses = {change.old_chat_member.status, change.new_chat_member.status}
+    if statuses & {ChatMember.CREATOR, ChatMember.ADMINISTRATOR}:
+        admins.refresh(change.chat.id)
 
 
 def check_group_values(update: Update, context: CallbackContext, language: str, pokestop: str, timezone: str) -> bool:
     languages = bot_utils.get_languages(database)
     if language not in languages:
-        update.message.reply_text('Invalid language, available languages:\n' + "\n".join([lang for lang in languages]))
+        reply(update, 'Invalid language, available languages:\n' + "\n".join([lang for lang in languages]), wait=False)
         return False
 
     if (not isinstance(pokestop, bool)):
-        update.message.reply_text("Pokestop has to be '0'(False), '1'(True), 'True' or 'False'")
+        reply(update, "Pokestop has to be '0'(False), '1'(True), 'True' or 'False'", wait=False)
         return False
 
     if timezone not in bot_utils.get_timezones():
-        update.message.reply_text(
+        reply(update,
             "Timezone has to be in format 'GMTX'\n" + "Check possible values with <code>/get_timezones</code>",
-            parse_mode=parse_mode
+            parse_mode=parse_mode,
+            wait=False
         )  
         return False
 
@@ -93,21 +119,16 @@ def check_group_values(update: Update, context: CallbackContext, language: str,
 
 
 def check_group_exists(update: Update, context: CallbackContext) -> Union[bool, str]:
-    with suppress(Exception):
-        return bot_utils.get_attr(
-            database,
-            id=update.effective_chat.id,
-            collection='groups'
-        )
-
-    return False
+    group = bot_utils.get_group(database, update.effective_chat.id)
+    return group.language if group else False
 
 
 def get_timezones(update: Update, context: CallbackContext):
     timezones = bot_utils.get_timezones()
-    update.message.reply_text(
+    reply(update,
         ",".join([f"<code>{timezone}</code>" for timezone in timezones]),
-        parse_mode=parse_mode
+        parse_mode=parse_mode,
+        wait=False
     )  
 
 
@@ -124,9 +145,10 @@ def get_rewards(update: Update, context: CallbackContext):
         language
     )
 
-    update.message.reply_text(
+    reply(update,
         ",".join([f"<code>{reward}</code>" for reward in rewards]),
-        parse_mode=parse_mode
+        parse_mode=parse_mode,
+        wait=False
     )
 
   
@@ -134,85 +156,173 @@ def get_reports(update: Update, context: CallbackContext):
     group_id = update.effective_chat.id
     language = check_group_exists(update, context)    
     reward = update.message.text.split(" ")[1]
-    check = False
-    try:
-        if update.message.text.split(" ")[2] == "1":
-            check = True
-        
-    except Exception:
-        pass
+
+    # '1': coordinates, 'v': one venue per report, '0': plain list
+    mode = '0'
+    with suppress(Exception):
+        if update.message.text.split(" ")[2] in ['1', 'v']:
+            mode = update.message.text.split(" ")[2]
 
     id = update.message.message_id
 
     # Unknown reward
-    if reward not in bot_utils.get_available_rewards(database, language):
-        update.message.reply_text(
+    if not bot_utils.is_reward(database, reward, language):
+        sent = reply(update,
             bot_utils.get_text(database, language, "unknown_reward"),
             parse_mode=parse_mode
         )
-        time.sleep(sleep)
-        remove_messages(update, context, [id, id+1])
+        remove_messages(update, context, [id, sent.message_id], delay=sleep)
         return
 
     # Send messages
     with suppress(Exception):
-        reports = bot_utils.read_reports(database, group_id, reward)
-
-        if reports.count() == 0:
-            update.message.reply_text(
+        if bot_utils.count_reports(database, group_id, reward) == 0:
+            sent = reply(update,
                 bot_utils.get_text(database, language, 'no_reports')
             )
-            time.sleep(sleep)
-            remove_messages(update, context, [id, id+1])
+            remove_messages(update, context, [id, sent.message_id], delay=sleep)
             return
 
-        bot.send_message(
-            text=f"{reward}:",
-            chat_id=update.message.from_user.id,
-        )
+        send_reports_page(update.message.from_user.id, group_id, reward, language, 0, mode)
+        remove_messages(update, context, [id])
+        return
+
+    # If messages can't be sent, tell the user to open conv
+    sent = reply(update,
+        bot_utils.get_text(database, language, "open_private"),
+        reply_markup=bot_utils.get_private_button(database, language)
+    )
+    remove_messages(update, context, [id, sent.message_id], delay=sleep)
+
+
+def send_reports_page(chat_id: int, group_id: int, reward: str, language: str, page: int, mode: str, message_id: int=None):
+    # One message per page, or a venue per report on venue mode
+    total = bot_utils.count_reports(database, group_id, reward)
+    pages = max(1, -(-total // config.page_size))
+    page = min(page, pages - 1)
+    reports = list(bot_utils.read_reports(database, group_id, reward, page*config.page_size, config.page_size))
+    location_text = bot_utils.get_text(database, language, 'location')
+
+    markup = None
+    if page + 1 < pages:
+        markup = bot_utils.get_page_button(group_id, reward, page + 1, mode)
+
+    if mode == 'v':
         for report in reports:
-            # Send location
-            bot.send_location(
-                chat_id=update.message.from_user.id,
+            outbox.call('send_venue',
+                chat_id=chat_id,
+                latitude=report['latitude'],
                 longitude=report['longitude'],
-                latitude=report['latitude']
+                title=report.get('pokestop') or location_text,
+                address=f"{report['latitude']}, {report['longitude']}"
             )
+        text = f"{reward} ({page+1}/{pages})"
 
-            # Send pokestop
-            with suppress(Exception):
-                bot.send_message(
-                    text=f"{report['pokestop']}",
-                    chat_id=update.message.from_user.id,
-                    parse_mode=parse_mode
-                )
+    else:
+        text = f"{reward} ({page+1}/{pages}):\n" + bot_utils.format_reports(reports, location_text, mode == '1', page*config.page_size)
 
-            # Send coordinates
-            if check:
-                bot.send_message(
-                    text=f"<code>{report['latitude']}, {report['longitude']}</code>",
-                    chat_id=update.message.from_user.id,
-                    parse_mode=parse_mode
-                )
-                
+    # Next pages replace the previous one
+    if message_id and mode != 'v':
+        outbox.submit('edit_message_text',
+            chat_id=chat_id,
+            message_id=message_id,
+            text=text,
+            parse_mode=parse_mode,
+            disable_web_page_preview=True,
+            reply_markup=markup
+        )
+        return
+
+    outbox.call('send_message',
+        chat_id=chat_id,
+        text=text,
+        parse_mode=parse_mode,
+        disable_web_page_preview=True,
+        reply_markup=markup
+    )
+
+
+def reports_page(update: Update, context: CallbackContext):
+    query = update.callback_query
+    _, group_id, page, mode, reward = query.data.split(',', 4)
+    group_id = int(group_id)
+    outbox.submit('answer_callback_query', callback_query_id=query.id)
+
+    group = bot_utils.get_group(database, group_id)
+    if group:
+        send_reports_page(query.message.chat_id, group_id, reward, group.language, int(page), mode, query.message.message_id)
+
+
+def near_reports(update: Update, context: CallbackContext):
+    group_id = update.effective_chat.id
+    language = check_group_exists(update, context)
+    id = update.message.message_id
+
+    # /near reward radius, replying to a location
+    location = None
+    with suppress(Exception):
+        reward, radius = update.message.text.split(" ")[1:3]
+        radius = float(radius)
+        location = update.message.reply_to_message.location
+
+    # $geoNear rejects negative, nan and infinite distances
+    if location is None or not 0 < radius < math.inf:
+        sent = reply(update,
+            "Usage: reply to a location with <code>/near reward radius(km)</code>",
+            parse_mode=parse_mode
+        )
+        remove_messages(update, context, [id, sent.message_id], delay=sleep)
+        return
+
+    # Unknown reward
+    if not bot_utils.is_reward(database, reward, language):
+        sent = reply(update,
+            bot_utils.get_text(database, language, "unknown_reward"),
+            parse_mode=parse_mode
+        )
+        remove_messages(update, context, [id, sent.message_id], delay=sleep)
+        return
+
+    reports = bot_utils.near_reports(database, group_id, reward, location.longitude, location.latitude, radius, config.page_size)
+    if not reports:
+        sent = reply(update,
+            bot_utils.get_text(database, language, 'no_reports')
+        )
+        remove_messages(update, context, [id, sent.message_id], delay=sleep)
+        return
+
+    # Send messages
+    with suppress(Exception):
+        location_text = bot_utils.get_text(database, language, 'location')
+        outbox.call('send_message',
+            chat_id=update.message.from_user.id,
+            text=f"{reward} ({radius:g} km):\n" + bot_utils.format_reports(reports, location_text),
+            parse_mode=parse_mode,
+            disable_web_page_preview=True
+        )
         remove_messages(update, context, [id])
         return
 
     # If messages can't be sent, tell the user to open conv
-    update.message.reply_text(
+    sent = reply(update,
         bot_utils.get_text(database, language, "open_private"),
         reply_markup=bot_utils.get_private_button(database, language)
     )
-    time.sleep(sleep)
-    remove_messages(update, context, [id, id+1])
+    remove_messages(update, context, [id, sent.message_id], delay=sleep)
+
 
+def remove_messages(update: Update, context: CallbackContext, ids: [int], delay: float=0):
+    # Delayed deletions are left to the JobQueue, so the worker is free meanwhile
+    if delay:
+        deleter.schedule(update.effective_chat.id, ids, delay)
+        return
 
-def remove_messages(update: Update, context: CallbackContext, ids: [int]):
+    # Nobody waits on the result, failed deletions are just dropped. Clean-up goes after replies
     for id in ids:
-        with suppress(Exception):
-            bot.deleteMessage(
-                chat_id=update.effective_chat.id,
-                message_id=id
-            )
+        outbox.submit('delete_message', outbound.BULK,
+            chat_id=update.effective_chat.id,
+            message_id=id
+        )
 
 
 def error_callback(update: Update, context: CallbackContext):
@@ -228,8 +338,9 @@ def start(update: Update, context: CallbackContext):
         return
        
     # If registered, help text
-    update.message.reply_text(
-        bot_utils.get_text(database, language, 'start_reg')
+    reply(update,
+        bot_utils.get_text(database, language, 'start_reg'),
+        wait=False
     ) 
 
 
@@ -241,32 +352,41 @@ def help(update: Update, context: CallbackContext):
         return
     
     commands = bot_utils.get_commands(database, language)
-    update.message.reply_text(
+    reply(update,
         '\n'.join(commands),
-        parse_mode=parse_mode
+        parse_mode=parse_mode,
+        wait=False
     )
 
 
 def delete_event(update: Update, context: CallbackContext):
     if update.message.from_user.username == config.username:
         bot_utils.delete_event(database)
-        update.message.reply_text("Done")
+        reply(update, "Done", wait=False)
         return
-    update.message.reply_text("You can't do that")
-    bot.send_message(
+    reply(update, "You can't do that", wait=False)
+    outbox.submit('send_message',
         text=f"WARNING @{update.message.from_user.username} tried to delete event",
         chat_id=354728208
     )
         
 
+def reload_texts(update: Update, context: CallbackContext):
+    if update.message.from_user.username == config.username:
+        bot_utils.reload_texts(database)
+        reply(update, "Done", wait=False)
+        return
+    reply(update, "You can't do that", wait=False)
+        
+
 def delete_timezone(update: Update, context: CallbackContext):
     if update.message.from_user.username == config.username:
         tz = update.message.text.split(' ')[1]
-        bot_utils.delete_reports(database, tz, bot)
-        update.message.reply_text("Done")
+        bot_utils.delete_reports(database, tz, outbox, deleter)
+        reply(update, "Done", wait=False)
         return
-    update.message.reply_text("You can't do that")
-    bot.send_message(
+    reply(update, "You can't do that", wait=False)
+    outbox.submit('send_message',
         text=f"WARNING @{update.message.from_user.username} tried to delete timezone",
         chat_id=354728208
     )
@@ -277,27 +397,18 @@ def delete_report(update: Update, context: CallbackContext):
         user_id = update.message.from_user.id
         language = check_group_exists(update, context)
         if not check_admin(update, context, user_id):
-            sent = update.message.reply_text(bot_utils.get_text(database, language, 'admin'))
-            time.sleep(sleep)
-            bot.delete_message(
-                chat_id=sent.chat_id,
-                message_id=sent.message_id
-            )
+            sent = reply(update, bot_utils.get_text(database, language, 'admin'))
+            deleter.schedule(sent.chat_id, [sent.message_id], sleep)
             return
         
-        delete_id = update.message.reply_to_message.message_id
-        bot_utils.delete_report(database, bot, delete_id, update.effective_chat.id)
-        sent = update.message.reply_text('✅')
-        time.sleep(2)
-        for id in [sent.message_id, update.message.message_id]:
-            with suppress(Exception):
-                bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=id
-                )
+        # Replying to anything that isn't a report just does nothing, like before
+        if update.message.reply_to_message is not None:
+            bot_utils.delete_report(database, outbox, update.message.reply_to_message.message_id, update.effective_chat.id)
+        sent = reply(update, '✅')
+        remove_messages(update, context, [sent.message_id, update.message.message_id], delay=2)
         return
 
-    bot.send_message(
+    outbox.submit('send_message',
         text="This group isn't registered, check <code>/add_group</code>",
         chat_id=update.effective_chat.id,
         parse_mode=parse_mode
@@ -305,9 +416,10 @@ def delete_report(update: Update, context: CallbackContext):
 
 
 def set_lang_start(update: Update, context: CallbackContext):
-    update.message.reply_text(
+    reply(update,
         'Select your language',
-        reply_markup=bot_utils.array_to_keyboard(bot_utils.get_languages(database))
+        reply_markup=bot_utils.array_to_keyboard(bot_utils.get_languages(database)),
+        wait=False
     )
 
 
@@ -317,29 +429,24 @@ def set_lang_command(update: Update, context: CallbackContext):
         language = update.message.text.split(" ")[1]
         language = language[0].upper() + language[1:].lower()
         if language not in languages:
-            update.message.reply_text(
+            reply(update,
                 "Usage:\n<i>/set_lang language</i>\n\nAvailable languages are:\n" + 
                 "\n".join([f'<code>{lang}</code>' for lang in languages]),
-                parse_mode=parse_mode
+                parse_mode=parse_mode,
+                wait=False
             )
             return
             
-        database['users'].update_one(
-            {
-                'user_id': update.message.from_user.id
-            },
-            {
-                '$set': {'language': language}
-            }
-        )    
-        update.message.reply_text("🤖👍🏻")
+        bot_utils.set_language(database, update.message.from_user.id, language)
+        reply(update, "🤖👍🏻", wait=False)
         return
 
 
-    update.message.reply_text(
+    reply(update,
             "Usage:\n<i>/set_lang language</i>\n\nAvailable languages are:\n" + 
             "\n".join([f'<code>{lang}</code>' for lang in languages]),
-            parse_mode=parse_mode
+            parse_mode=parse_mode,
+            wait=False
         )
                 
 
@@ -348,12 +455,8 @@ def add_group(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
     language = check_group_exists(update, context)     
     if not check_admin(update, context, user_id):
-        sent = update.message.reply_text(bot_utils.get_text(database, language if language else 'English', 'admin'))
-        time.sleep(sleep)
-        bot.delete_message(
-            chat_id=sent.chat_id,
-            message_id=sent.message_id
-        )
+        sent = reply(update, bot_utils.get_text(database, language if language else 'English', 'admin'))
+        deleter.schedule(sent.chat_id, [sent.message_id], sleep)
         return
     
     # Parse values
@@ -390,9 +493,9 @@ def add_group(update: Update, context: CallbackContext):
                     timezone,
                     confirmation
                 )
-                update.message.reply_text("Group created 🤖👍🏻")
+                reply(update, "Group created 🤖👍🏻", wait=False)
 
-                update.message.reply_text("To change configuration, use this command again with the new values")
+                reply(update, "To change configuration, use this command again with the new values", wait=False)
                 return
             
             # Else, edit
@@ -404,7 +507,7 @@ def add_group(update: Update, context: CallbackContext):
                 timezone,
                 confirmation
             )
-            update.message.reply_text("Group configuration updated 🤖👍🏻")
+            reply(update, "Group configuration updated 🤖👍🏻", wait=False)
             return
         
         # Values weren't correct
@@ -415,7 +518,7 @@ def add_group(update: Update, context: CallbackContext):
 
 
 def group_error(update: Update, context: CallbackContext):
-    update.message.reply_text(
+    reply(update,
         """Usage: <code>/add_group language pokestop timezone confirmation</code>
 -Language: <i>Group's language</i> 
 -Pokestop: <i>Reports with or without pokestop name</i> 
@@ -423,7 +526,8 @@ def group_error(update: Update, context: CallbackContext):
 -Confirmation: <i>Ask confirmation before continuing(use it to avoid problems with other bots, defaults to False)</i>
         
 <b>For example: /add_group English 0 GMT+1 or /add_group Español 1 GMT+3 1</b>""",
-        parse_mode=parse_mode
+        parse_mode=parse_mode,
+        wait=False
     )
 
 
@@ -436,34 +540,23 @@ def inline_keyboard_handler(update: Update, context: CallbackContext):
         message_id = query.message.message_id
         language = check_group_exists(update, context)
 
-        reward, longitude, latitude, pokestop_name, location_id = query.data.split(',')  
-
-        # Edit text
-        old_text = query.message.text
-        rows = old_text.split('\n')
-        rows[0] = f"<a href='https://www.google.com/maps/search/?api=1&query={latitude},{longitude}'>{rows[0]}</a>"
-        new_row = rows[1].split(',')
-        new_row[0] = f"<b>{reward}</b>"
-        new_row[1] = f"<i>{new_row[1]}</i>"
-        rows[1] = ','.join(new_row)
-
-        new_text_rows = []
-        new_text_rows.extend(rows[0:2])
-        cp = database['tasks'].find_one(
-                {
-                    f'{language}.reward': reward.split('✨')[0]
-                },
-                {
-                    '_id': False
-                }
-            )['cp']
-
-        new_text_rows.append(f'💯: {cp}')
-        new_text_rows.append(rows[2])
-        new_text_rows.append(f"{bot_utils.get_text(database, language, 'confirmed')} @{username}")
-        new_text = '\n'.join(new_text_rows)
-
-        bot.edit_message_text(
+        # Pokestop names may have commas, location_id is always last
+        reward, longitude, latitude, rest = query.data.split(',', 3)
+        pokestop_name, location_id = rest.rsplit(',', 1)
+        name = reward.split('✨')[0]
+
+        # CP comes from the catalog, no query needed
+        info = bot_utils.get_reward_info(database, name, language)
+        new_text = bot_utils.format_confirmed(
+            query.message.text,
+            reward,
+            info[0] if info else None,
+            longitude,
+            latitude,
+            f"{bot_utils.get_text(database, language, 'confirmed')} @{username}"
+        )
+
+        outbox.submit('edit_message_text',
             chat_id=query.message.chat_id,
             message_id=message_id,
             text=new_text,
@@ -480,18 +573,18 @@ def inline_keyboard_handler(update: Update, context: CallbackContext):
             int(location_id),
             longitude,
             latitude,
-            reward.split('✨')[0],
-            pokestop_name
+            name,
+            pokestop_name,
+            writer=writer
         )
         return
 
     data = update.callback_query.data
     if data == 'continue' or data =='cancel':
-        with suppress(Exception):
-            bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=update.callback_query.message.message_id
-            )
+        outbox.submit('delete_message', outbound.BULK,
+            chat_id=update.effective_chat.id,
+            message_id=update.callback_query.message.message_id
+        )
 
 
 def default_private_handler(update: Update, context: CallbackContext):
@@ -509,19 +602,21 @@ def default_private_handler(update: Update, context: CallbackContext):
                 user_id,
                 text
             )
-            update.message.reply_text(
+            reply(update,
                 bot_utils.get_text(database, language, 'registered'),
-		        reply_markup=ReplyKeyboardRemove()
+		        reply_markup=ReplyKeyboardRemove(),
+                wait=False
             )
             return
     
         # If not, tell the user to set up language
-        update.message.reply_text("Please set up your language with /start")
+        reply(update, "Please set up your language with /start", wait=False)
         return
 
     # If registered
-    update.message.reply_text(
-        bot_utils.get_text(database, language, 'default')
+    reply(update,
+        bot_utils.get_text(database, language, 'default'),
+        wait=False
     )
 
 
@@ -530,68 +625,69 @@ def default_private_handler(update: Update, context: CallbackContext):
 # # # # # # # # # # # # ============================ # # # # # # # # # # # #
 
 CATEGORY, POKESTOP, TASK, CONFIRMATION = range(4)
-location = []
-location_id = 0
-pokestop_name = ""
-ids = []
 
 conv_state = typing.NewType('state', int)
 
+def get_report(update: Update, context: CallbackContext) -> dict:
+    # Conversations are tracked per (chat, user), so is the report being built
+    reports = context.chat_data.setdefault('reports', {})
+    return reports.setdefault(update.effective_user.id, {
+        'location': None,
+        'location_id': 0,
+        'pokestop_name': "",
+        'ids': []
+    })
+
+
 def coords_location(update: Update, context: CallbackContext) -> conv_state:
-    global location, location_id
-    # Save location to global variable
+    report = get_report(update, context)
+    # Save location on the conversation's report
     id = update.message.message_id
-    ids.append(id)
-    location = my_location(
+    report['ids'].append(id)
+    report['location'] = my_location(
         latitude=update.message.text.split(',')[0],
         longitude=update.message.text.split(',')[1]
     )
 
     # Send location
-    sent = bot.send_location(
+    sent = outbox.call('send_location',
         chat_id=update.effective_chat.id,
-        latitude=location.latitude,
-        longitude=location.longitude
+        latitude=report['location'].latitude,
+        longitude=report['location'].longitude
     )
 
-    location_id = sent.message_id
+    report['location_id'] = sent.message_id
 
     # Do the rest
     return confirmation(update, context)
 
 
 def telegram_location(update: Update, context: CallbackContext) -> conv_state:
-    global location, location_id
-    # Save location to global variable
+    report = get_report(update, context)
+    # Save location on the conversation's report
     id = update.message.message_id
-    location_id = id
-    location = update.message.location
+    report['location_id'] = id
+    report['location'] = update.message.location
 
     # Do the rest
     return confirmation(update, context)
 
 
 def confirmation(update: Update, context: CallbackContext) -> conv_state:
-    group_language = check_group_exists(update, context)
-    # Get value
-    confirmation = bot_utils.get_attr(
-        database,
-        id=update.effective_chat.id,
-        attribute='confirmation',
-        collection='groups'
-    )
+    group = bot_utils.get_group(database, update.effective_chat.id)
+    group_language = group.language
 
     # If not confirmation needed, continue with the process
-    if not confirmation:
+    if not group.confirmation:
         return reply_to_location(update, context)
     
     confirmation_text = bot_utils.get_text(database, group_language, 'confirmation')
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('✅', callback_data='continue'), InlineKeyboardButton('❌', callback_data='cancel')]])
-    sent = update.message.reply_text(
+    sent = reply(update,
         text=confirmation_text,
         reply_markup=keyboard
     )
-    ids.append(sent.message_id)
+    get_report(update, context)['ids'].append(sent.message_id)
 
     return CONFIRMATION
 
@@ -600,7 +696,7 @@ def confirmation_handler(update: Update, context: CallbackContext) -> conv_state
     query = update.callback_query
     confirmation = query.data
     message_id = query.message.message_id
-    ids.append(message_id)
+    get_report(update, context)['ids'].append(message_id)
 
     if confirmation == 'continue':          
         return reply_to_location(update, context)
@@ -610,8 +706,7 @@ def confirmation_handler(update: Update, context: CallbackContext) -> conv_state
 
 def reply_to_location(update: Update, context: CallbackContext) -> conv_state:  
     group_language = check_group_exists(update, context) 
-    # Save location and id
-    global location, ids, location_id
+    report = get_report(update, context)
     try:
         id = update.message.message_id
     except Exception:
@@ -621,52 +716,37 @@ def reply_to_location(update: Update, context: CallbackContext) -> conv_state:
         # Check if user is registered
         user_id, user_language = check_user(update, context)   
         if not user_language:
-            sent =  bot.send_message(
+            sent =  outbox.call('send_message',
                 text=bot_utils.get_text(database, group_language, "register"),
                 chat_id=update.effective_chat.id,
                 reply_markup=bot_utils.get_private_button(database, group_language)
             )
-            time.sleep(sleep)
-            for message_id in [id, sent.message_id]:
-                with suppress(Exception):
-                    bot.delete_message(
-                        message_id=message_id,
-                        chat_id = update.effective_chat.id
-                    )
-
+            remove_messages(update, context, [id, sent.message_id], delay=sleep)
             return ConversationHandler.END
 
         # Continue with pokestop/category            
-        pokestop = bot_utils.get_attr(
-            database,
-            id=update.effective_chat.id,
-            attribute='pokestop',
-            collection='groups'
-        )    
-
-        if pokestop:
+        if bot_utils.get_group(database, update.effective_chat.id).pokestop:
             try:
-                sent =  update.message.reply_text(
+                sent =  reply(update,
                     text=bot_utils.get_text(database, group_language, 'pokestop'),
-                    chat_id=update.effective_chat.id,
                     reply_markup=ReplyKeyboardRemove()
                 )
 
             except Exception:
-                sent =  bot.send_message(
+                sent =  outbox.call('send_message',
                     text=bot_utils.get_text(database, group_language, 'pokestop'),
                     chat_id=update.effective_chat.id,
                     reply_markup=ReplyKeyboardRemove()
                 )
 
-            ids.append(sent.message_id)
+            report['ids'].append(sent.message_id)
             return POKESTOP
             
         else:
             return ask_category(update, context)
     
     # If group wasn't registered
-    bot.send_message(
+    outbox.submit('send_message',
         text="This group isn't registered, check <code>/add_group</code>",
         chat_id=update.effective_chat.id,
         parse_mode=parse_mode
@@ -675,14 +755,14 @@ def reply_to_location(update: Update, context: CallbackContext) -> conv_state:
 
 
 def reply_to_pokestop(update: Update, context: CallbackContext) -> conv_state:
-    global pokestop_name
-    pokestop_name = update.message.text
+    report = get_report(update, context)
+    report['pokestop_name'] = update.message.text
     try:
         id = update.message.message_id
     except Exception:
         id = update.callback_query.message.message_id
         
-    ids.append(id)
+    report['ids'].append(id)
     return ask_category(update, context)
 
 
@@ -690,53 +770,53 @@ def ask_category(update: Update, context: CallbackContext) -> conv_state:
     language = check_group_exists(update, context)
     categories = bot_utils.get_categories(database, language)
     try:
-        sent =  update.message.reply_text(
+        sent =  reply(update,
             text=bot_utils.get_text(database, language, 'category'),
             reply_markup=bot_utils.array_to_keyboard(categories)
         )
     
     except Exception:
-        sent =  bot.send_message(
+        sent =  outbox.call('send_message',
             text=bot_utils.get_text(database, language, 'category'),
             chat_id=update.effective_chat.id,
             reply_markup=bot_utils.array_to_keyboard(categories, selective=False)
         )
 
-    ids.append(sent.message_id)
+    get_report(update, context)['ids'].append(sent.message_id)
     return CATEGORY
 
 
 def reply_to_category(update: Update, context: CallbackContext) -> conv_state:
     language = check_group_exists(update, context)
+    report = get_report(update, context)
     category = update.message.text
 
     id = update.message.message_id
-    ids.append(id)
+    report['ids'].append(id)
 
     # Check category
-    if category not in bot_utils.get_categories(database, language):
-        sent =  update.message.reply_text(
+    if not bot_utils.is_category(database, category, language):
+        sent =  reply(update,
                 bot_utils.get_text(database, language, "keyboard")
             )
-        ids.append(sent.message_id)
+        report['ids'].append(sent.message_id)
 
-        ids.append(location_id)
-        time.sleep(sleep)
-        return end_conv_handler(update, context)
+        report['ids'].append(report['location_id'])
+        return end_conv_handler(update, context, delay=sleep)
 
-    tasks = bot_utils.get_tasks(database, category, language)
-    
-    sent =  update.message.reply_text(
+    sent =  reply(update,
         bot_utils.get_text(database, language,'task'),
-        reply_markup=bot_utils.array_to_keyboard(tasks),
+        reply_markup=bot_utils.get_task_keyboard(database, category, language),
         parse_mode=parse_mode
     )
-    ids.append(sent.message_id)
+    report['ids'].append(sent.message_id)
     return TASK
 
 
 def save_task(update: Update, context: CallbackContext) -> conv_state:
     language = check_group_exists(update, context)
+    report = get_report(update, context)
+    location, location_id, pokestop_name, ids = report['location'], report['location_id'], report['pokestop_name'], report['ids']
     text = update.message.text
     reward = text.split(",")[0]
     location_text = bot_utils.get_text(database, language, 'location')
@@ -746,36 +826,25 @@ def save_task(update: Update, context: CallbackContext) -> conv_state:
     id = update.message.message_id
     ids.append(id)
 
-    if '/' not in text:
+    multiple = '/' in text
+    if not multiple:
         reward = reward.split('✨')[0]
         # If unknown reward, cancel report
-        if reward not in bot_utils.get_available_rewards(database, language):
-            sent =  update.message.reply_text(
+        if not bot_utils.is_reward(database, reward, language):
+            sent =  reply(update,
                 bot_utils.get_text(database, language, "keyboard"),
                 reply_markup=ReplyKeyboardRemove(selective=False)
             )
             ids.append(id)
             ids.append(location_id)
             ids.append(sent.message_id)
-            time.sleep(sleep)
-            return end_conv_handler(update, context)
+            return end_conv_handler(update, context, delay=sleep)
 
         rows = text.split('\n')
         rows[0] = f"<b>{rows[0].split(',')[0]}</b>, <i>{','.join(rows[0].split(',')[1:])}</i>"
         text = '\n'.join(rows)
         
         text = f"{link}\n{text}\n{bot_utils.get_text(database, language, 'reported')} @{update.message.from_user.username}"
-        bot_utils.save_task(
-            database,
-            update.effective_chat.id,
-            update.message.message_id+1,
-            update.message.from_user.id,
-            location_id,
-            location.longitude,
-            location.latitude,
-            reward, 
-            pokestop_name
-        )        
         markup = ReplyKeyboardRemove(selective=False)
     
     else: 
@@ -784,24 +853,15 @@ def save_task(update: Update, context: CallbackContext) -> conv_state:
 
         # Check they are correct
         for reward in rewards:
-             if reward.split('✨')[0] not in bot_utils.get_available_rewards(database, language):
-                sent = update.message.reply_text(
+             if not bot_utils.is_reward(database, reward.split('✨')[0], language):
+                sent = reply(update,
                     bot_utils.get_text(database, language, "keyboard"),
                     reply_markup=ReplyKeyboardRemove(selective=False)
                 )
                 ids.append(id)
                 ids.append(location_id)
                 ids.append(sent.message_id)
-                time.sleep(sleep)
-                return end_conv_handler(update, context)    
-        
-        # Save id to delete later
-        bot_utils.save_unconfirmed(
-            database,
-            update.effective_chat.id,
-            update.message.message_id+1,
-            location_id
-        )
+                return end_conv_handler(update, context, delay=sleep)    
 
         text = f"{link}\n<b>{bot_utils.get_text(database, language, 'unknown')}</b>,<i>{text.split(',')[1]}</i>\n{bot_utils.get_text(database, language, 'reported')} @{update.message.from_user.username}"
         keyboard = []
@@ -810,9 +870,8 @@ def save_task(update: Update, context: CallbackContext) -> conv_state:
             keyboard.append(button)
         markup = InlineKeyboardMarkup([keyboard])
 
-        
-    
-    bot.send_message(
+    # Sent first, other replies may take the next message id meanwhile
+    sent = outbox.call('send_message',
         chat_id=update.effective_chat.id,
         text=text,
         parse_mode=parse_mode,
@@ -820,74 +879,164 @@ def save_task(update: Update, context: CallbackContext) -> conv_state:
         reply_markup=markup
     )
 
+    # Save id to delete later
+    if not multiple:
+        bot_utils.save_task(
+            database,
+            update.effective_chat.id,
+            sent.message_id,
+            update.message.from_user.id,
+            location_id,
+            location.longitude,
+            location.latitude,
+            reward, 
+            pokestop_name,
+            writer=writer
+        )
+    else:
+        bot_utils.save_unconfirmed(
+            database,
+            update.effective_chat.id,
+            sent.message_id,
+            location_id
+        )
+
     return end_conv_handler(update, context)
 
 
-def end_conv_handler(update: Update, context: CallbackContext) -> conv_state:
-    global location, location_id, pokestop_name, ids
+def end_conv_handler(update: Update, context: CallbackContext, delay: float=0) -> conv_state:
+    report = context.chat_data.get('reports', {}).pop(update.effective_user.id, None)
+    ids = report['ids'] if report else []
     with suppress(Exception):
         id = update.message.message_id
         ids.append(id)
 
-    remove_messages(update, context, ids)
-    location, location_id, pokestop_name, ids = [], 0, "", []
+    remove_messages(update, context, ids, delay)
     return ConversationHandler.END
 
 
 conversation_handler = ConversationHandler(
     entry_points=[
-        MessageHandler(Filters.chat_type.groups & Filters.location, telegram_location),
-        MessageHandler(Filters.chat_type.groups & Filters.regex(r'[+-]?[0-9]+(\.[0-9]+)?,[ ]?[+-]?[0-9]+(\.[0-9]+)?'), coords_location)
+        MessageHandler(Filters.chat_type.groups & Filters.location, telegram_location, run_async=True),
+        MessageHandler(Filters.chat_type.groups & Filters.regex(r'[+-]?[0-9]+(\.[0-9]+)?,[ ]?[+-]?[0-9]+(\.[0-9]+)?'), coords_location, run_async=True)
     ],
 
     states={
         CONFIRMATION: [
-            CallbackQueryHandler(confirmation_handler)
+            CallbackQueryHandler(confirmation_handler, run_async=True)
         ],
         CATEGORY: [	
-            MessageHandler(Filters.text, reply_to_category)
+            MessageHandler(Filters.text, reply_to_category, run_async=True)
         ],
 
         POKESTOP: [	
-            MessageHandler(Filters.text, reply_to_pokestop)
+            MessageHandler(Filters.text, reply_to_pokestop, run_async=True)
         ],
 
         TASK: [
-            MessageHandler(Filters.text, save_task)
+            MessageHandler(Filters.text, save_task, run_async=True)
         ]
     },
 
     fallbacks=[	
-        MessageHandler(Filters.regex('Cancel'), end_conv_handler)
+        MessageHandler(Filters.regex('Cancel'), end_conv_handler, run_async=True)
     ]
 )
 
 
-def main():   
+def register_handlers(dp: Dispatcher):
     # Clear 
-    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/delete_timezone"), delete_timezone))   
-    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/delete_event"), delete_event))    
+    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/delete_timezone"), delete_timezone, run_async=True))   
+    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/delete_event"), delete_event, run_async=True))    
+    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/reload_texts"), reload_texts, run_async=True))
     
     # Any chat
-    dp.add_handler(MessageHandler(Filters.regex("^/help"), help))
-    dp.add_handler(CommandHandler("get_timezones", get_timezones))
+    dp.add_handler(MessageHandler(Filters.regex("^/help"), help, run_async=True))
+    dp.add_handler(CommandHandler("get_timezones", get_timezones, run_async=True))
     dp.add_handler(conversation_handler)
-    dp.add_handler(CallbackQueryHandler(inline_keyboard_handler))
+    dp.add_handler(CallbackQueryHandler(reports_page, pattern=r'^page,', run_async=True))
+    dp.add_handler(CallbackQueryHandler(inline_keyboard_handler, run_async=True))
+    dp.add_handler(ChatMemberHandler(chat_member_changed, ChatMemberHandler.CHAT_MEMBER))
 
     # Only in group
-    dp.add_handler(MessageHandler(Filters.chat_type.groups & Filters.regex (r"^/delete$"), delete_report))
-    dp.add_handler(MessageHandler(Filters.chat_type.groups & Filters.regex(r"^/add_group"), add_group))
-    dp.add_handler(MessageHandler(Filters.chat_type.groups & Filters.regex(r"^/get"), get_reports))
+    dp.add_handler(MessageHandler(Filters.chat_type.groups & Filters.regex (r"^/delete$"), delete_report, run_async=True))
+    dp.add_handler(MessageHandler(Filters.chat_type.groups & Filters.regex(r"^/add_group"), add_group, run_async=True))
+    dp.add_handler(MessageHandler(Filters.chat_type.groups & Filters.regex(r"^/get"), get_reports, run_async=True))
+    dp.add_handler(MessageHandler(Filters.chat_type.groups & Filters.regex(r"^/near"), near_reports, run_async=True))
 
     # Only in private 
-    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/start"), start))    
-    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/set_lang"), set_lang_command))
-    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/rewards"), get_rewards))
-    dp.add_handler(MessageHandler(Filters.chat_type.private, default_private_handler))
+    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/start"), start, run_async=True))    
+    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/set_lang"), set_lang_command, run_async=True))
+    dp.add_handler(MessageHandler(Filters.chat_type.private & Filters.regex(r"^/rewards"), get_rewards, run_async=True))
+    dp.add_handler(MessageHandler(Filters.chat_type.private, default_private_handler, run_async=True))
+
+    dp.add_error_handler(error_callback, run_async=True)
+
+
+def main():
+    register_handlers(dp)
 
-    dp.add_error_handler(error_callback)
-    updater.start_polling()
+    # Time every handler, expose it all on /metrics
+    metrics.instrument(dp)
+    register_metrics()
+    if config.metrics_port:
+        metrics.serve()
+
+    # Create any missing index before serving queries
+    indexes.ensure_indexes(database)
+
+    # Every Bot API call goes through here
+    outbox.start()
+
+    # Keep texts and group settings in memory, refreshing them when the DB changes
+    catalog.watch(database, cache.groups)
+
+    # Delayed message deletions and midnight resets
+    deleter.start(updater.job_queue)
+    resets.start(updater.job_queue)
+
+    # Buffered counters and reports
+    writer.start(updater.job_queue)
+
+    serve()
     updater.idle()
 
+    # Nothing buffered may be lost on shutdown
+    writer.flush()
+
+
+def register_metrics():
+    metrics.registry.add(metrics.CallbackGauge('bot_queue_depth', 'Items waiting on each internal queue', lambda: {
+        'updates': dp.update_queue.qsize(),
+        'outbox': outbox.stats()['depth'],
+        'deletions': len(deleter),
+        'writes': len(writer),
+        'jobs_overdue': metrics.overdue_jobs(updater.job_queue)
+    }, ['queue']))
+    metrics.registry.add(metrics.CallbackGauge('bot_cache_hit_ratio', 'Hit ratio of each in-memory cache', lambda: {
+        'texts': catalog.texts.stats()['hit_rate'],
+        'groups': cache.groups.stats()['hit_rate'],
+        'users': cache.users.stats()['hit_rate'],
+        'admins': admins.stats()['hit_rate']
+    }, ['cache']))
+
+
+def serve():
+    if not config.webhook_url:
+        updater.start_polling(allowed_updates=allowed_updates)
+        return
+
+    # Conversation state isn't shared between processes, see config.py before running several replicas
+    # Updater's webhook server can't check Telegram's secret_token header, so the secret goes on the path
+    url_path = '/'.join(part for part in [config.webhook_path, config.webhook_secret] if part)
+    updater.start_webhook(
+        listen=config.webhook_listen,
+        port=config.webhook_port,
+        url_path=url_path,
+        webhook_url=f"{config.webhook_url.rstrip('/')}/{url_path}",
+        max_connections=config.webhook_connections,
+        allowed_updates=allowed_updates
+    )
+
 if __name__ == '__main__':
     main()
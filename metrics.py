@@ -0,0 +1,336 @@
+import config
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from pymongo import monitoring
+import threading
+import time
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a cache hit to a slow Telegram call
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========== METRICS ========= # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+def format_labels(names: [str], values: tuple, extra: str='') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: [str]=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, labels)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, *labels, value: float):
+        with self.lock:
+            self.values[labels] = value
+
+    def dec(self, *labels, amount: float=1):
+        self.inc(*labels, amount=-amount)
+
+    def expose(self) -> [str]:
+        lines = super().expose()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+
+class CallbackGauge(Gauge):
+    """Gauge read when scraped, for values that already live somewhere else."""
+
+    def __init__(self, name: str, help: str, function: Callable[[], dict], labels: [str]=()):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def expose(self) -> [str]:
+        try:
+            values = self.function()
+        except Exception as error:
+            logger.warning(f'Reading {self.name} failed: "{error}"')
+            values = {}
+
+        with self.lock:
+            self.values = {labels if isinstance(labels, tuple) else (labels,): value for labels, value in values.items()}
+        return super().expose()
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: [str]=(), buckets: tuple=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        # labels -> [per bucket counts (+Inf last), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                index = len(self.buckets)
+            counts[0][index] += 1
+            counts[1] += value
+
+    def expose(self) -> [str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f'{self.name}_bucket{format_labels(self.labels, labels, le)} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {total}')
+                lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_seconds   = registry.add(Histogram('bot_handler_seconds', 'Time spent on each dispatcher handler', ['handler']))
+handler_errors    = registry.add(Counter('bot_handler_errors_total', 'Exceptions raised by each dispatcher handler', ['handler']))
+updates_in_flight = registry.add(Gauge('bot_updates_in_flight', 'Updates being handled right now'))
+
+mongo_seconds = registry.add(Histogram('bot_mongo_command_seconds', 'Duration of each Mongo command', ['command', 'collection']))
+mongo_errors  = registry.add(Counter('bot_mongo_command_errors_total', 'Failed Mongo commands', ['command', 'collection']))
+
+telegram_seconds = registry.add(Histogram('bot_telegram_request_seconds', 'Duration of each Bot API call', ['method']))
+telegram_wait    = registry.add(Histogram('bot_telegram_queue_seconds', 'Time Bot API calls wait on the outbox', ['priority']))
+telegram_errors  = registry.add(Counter('bot_telegram_errors_total', 'Failed Bot API calls', ['method', 'error']))
+
+handler_queries = registry.add(Histogram('bot_handler_queries', 'Mongo commands per handled update (profiling mode)', ['handler'], (0, 1, 2, 3, 5, 8, 13, 21)))
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # ========= HANDLERS ========= # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+def timed(callback: Callable) -> Callable:
+    name = callback.__name__
+
+    def wrapper(update, context, *args, **kwargs):
+        updates_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            if config.profile_queries:
+                with profile(name, getattr(update, 'update_id', None), config.query_budget):
+                    return callback(update, context, *args, **kwargs)
+            return callback(update, context, *args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+            updates_in_flight.dec()
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+def instrument(dispatcher, decorator: Callable[[Callable], Callable]=timed):
+    # Wraps every registered callback, including the ones inside ConversationHandlers
+    def wrap(handler):
+        if hasattr(handler, 'entry_points'):
+            for inner in handler.entry_points + handler.fallbacks + [h for hs in handler.states.values() for h in hs]:
+                wrap(inner)
+            return
+
+        handler.callback = decorator(handler.callback)
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+
+def overdue_jobs(job_queue) -> int:
+    # JobQueue's backlog: jobs that should be running already
+    now = datetime.now(timezone.utc)
+    return sum(1 for job in job_queue.scheduler.get_jobs() if job.next_run_time and job.next_run_time <= now)
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # =========== MONGO ========== # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+# Commands not worth comparing when looking for repeated queries
+VOLATILE = frozenset(['lsid', '$clusterTime', '$db', '$readPreference', 'txnNumber', 'signature'])
+
+current = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryProfile:
+    """Every Mongo command issued on this thread while the profile is active."""
+
+    def __init__(self, handler: str='', update_id: int=None):
+        self.handler = handler
+        self.update_id = update_id
+        self.commands = []
+        self.seconds = 0
+        self.running = {}
+
+    def started(self, event: monitoring.CommandStartedEvent, collection: str):
+        shape = repr(sorted((key, value) for key, value in event.command.items() if key not in VOLATILE))
+        self.running[event.connection_id, event.request_id] = len(self.commands)
+        self.commands.append((event.command_name, collection, shape))
+
+    def finished(self, event: monitoring.CommandSucceededEvent):
+        if self.running.pop((event.connection_id, event.request_id), None) is not None:
+            self.seconds += event.duration_micros / 1e6
+
+    def repeated(self) -> dict:
+        # (command, collection, shape) -> times, for identical commands sent more than once
+        counts = {}
+        for command in self.commands:
+            counts[command] = counts.get(command, 0) + 1
+        return {command: times for command, times in counts.items() if times > 1}
+
+    def summary(self) -> str:
+        return f'{self.handler} (update {self.update_id}): {len(self.commands)} queries, {self.seconds * 1000:.1f}ms on the DB'
+
+
+@contextmanager
+def profile(handler: str='', update_id: int=None, budget: int=0, strict: bool=False) -> QueryProfile:
+    """Attributes the Mongo commands issued inside to `handler`.
+
+    Logs a summary, warns about repeated identical commands (N+1 patterns)
+    and about going over `budget` commands, raising QueryBudgetExceeded
+    instead when `strict`. Nested profiles only report on the outer one.
+    """
+    if getattr(current, 'profile', None) is not None:
+        yield current.profile
+        return
+
+    result = current.profile = QueryProfile(handler, update_id)
+    try:
+        yield result
+    finally:
+        current.profile = None
+
+    handler_queries.observe(len(result.commands), handler)
+    logger.info(result.summary())
+    for (command, collection, shape), times in result.repeated().items():
+        logger.warning(f'{handler} sent the same {command} on {collection} {times} times: {shape}')
+
+    if budget and len(result.commands) > budget:
+        message = f'{result.summary()}, over its budget of {budget}'
+        if strict:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+class MongoListener(monitoring.CommandListener):
+    """Times every command sent by the MongoClient it is registered on."""
+
+    def __init__(self):
+        self.collections = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        # Most commands name their collection as the command's value
+        collection = event.command.get(event.command_name)
+        collection = collection if isinstance(collection, str) else ''
+        self.collections[event.connection_id, event.request_id] = collection
+
+        # Commands are started on the thread that sends them, the handler's
+        active = getattr(current, 'profile', None)
+        if active is not None:
+            active.started(event, collection)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        collection = self.collections.pop((event.connection_id, event.request_id), '')
+        mongo_seconds.observe(event.duration_micros / 1e6, event.command_name, collection)
+        self.finished(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self.collections.pop((event.connection_id, event.request_id), '')
+        mongo_seconds.observe(event.duration_micros / 1e6, event.command_name, collection)
+        mongo_errors.inc(event.command_name, collection)
+        self.finished(event)
+
+    def finished(self, event: monitoring.CommandSucceededEvent):
+        active = getattr(current, 'profile', None)
+        if active is not None:
+            active.finished(event)
+
+
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+# # # # # # # # # # # # =========== SERVER ========= # # # # # # # # # # # #
+# # # # # # # # # # # # ============================ # # # # # # # # # # # #
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.expose().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        # Scrapes would flood the log otherwise
+        pass
+
+
+def serve(listen: str=config.metrics_listen, port: int=config.metrics_port) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Serving metrics on http://{listen}:{server.server_port}/metrics')
+    return server
+
+
+if __name__ == '__main__':
+    print("You shouldn't be executing this")
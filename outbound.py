@@ -0,0 +1,248 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import config
+import heapq
+import itertools
+import logging
+import metrics
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+import threading
+import time
+from typing import Any
+
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, BULK = range(2)
+# Telegram's per-chat limit is on messages sent, these don't use the chat's bucket
+UNMETERED = frozenset(['delete_message', 'get_chat_administrators'])
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self) -> float:
+        # Seconds until a token is available
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def idle(self) -> bool:
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class Request:
+    def __init__(self, method: str, kwargs: dict, priority: int, seq: int, not_before: float):
+        self.method = method
+        self.kwargs = kwargs
+        self.chat_id = kwargs.get('chat_id')
+        self.priority = priority
+        self.seq = seq
+        self.not_before = not_before
+        self.attempts = 0
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+    def __lt__(self, other: 'Request') -> bool:
+        return (self.not_before, self.seq) < (other.not_before, other.seq)
+
+
+class Outbox:
+    """Queue every Bot API call goes through.
+
+    Calls are throttled by a global token bucket (Telegram's ~30 msg/s) and,
+    for the ones sending messages, a per-chat one. Interactive replies are
+    served before bulk clean-up, and RetryAfter/network errors are retried
+    with backoff.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float=config.global_rate,
+        chat_rate: float=config.chat_rate,
+        chat_burst: float=config.chat_burst,
+        retries: int=config.send_retries,
+        workers: int=config.send_workers
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.blocked = {}
+        self.retries = retries
+        self.queues = {INTERACTIVE: [], BULK: []}
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='outbox')
+        self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+        self.counts = {'sent': 0, 'retried': 0, 'failed': 0}
+
+    def start(self):
+        self.thread.start()
+
+    def depth(self) -> dict:
+        return {priority: len(queue) for priority, queue in self.queues.items()}
+
+    def stats(self) -> dict:
+        return {**self.counts, 'depth': sum(self.depth().values())}
+
+    def submit(self, method: str, priority: int=INTERACTIVE, **kwargs) -> Future:
+        with self.condition:
+            # Keep per chat order: don't jump ahead of calls already waiting on that chat
+            not_before = self.blocked.get(kwargs.get('chat_id'), 0)
+            request = Request(method, kwargs, priority, next(self.counter), not_before)
+            heapq.heappush(self.queues[priority], request)
+            self.condition.notify()
+
+        return request.future
+
+    def call(self, method: str, priority: int=INTERACTIVE, **kwargs) -> Any:
+        return self.submit(method, priority, **kwargs).result()
+
+    def push(self, request: Request, not_before: float):
+        if request.chat_id is not None:
+            # Never earlier than calls already waiting on that chat, ties are broken by seq
+            not_before = max(self.blocked.get(request.chat_id, 0), not_before)
+            self.blocked[request.chat_id] = not_before
+        request.not_before = not_before
+        heapq.heappush(self.queues[request.priority], request)
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            # Forget chats that went quiet, so the dict doesn't grow forever
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {id: bucket for id, bucket in self.chat_buckets.items() if not bucket.idle()}
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        return self.chat_buckets[chat_id]
+
+    def next_request(self) -> (Request, float):
+        # Returns a ready request (highest priority first), or how long to wait for one
+        now = time.monotonic()
+        timeout = None
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            if not queue:
+                continue
+
+            if queue[0].not_before <= now:
+                return heapq.heappop(queue), 0
+
+            wait = queue[0].not_before - now
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        return None, timeout
+
+    def run(self):
+        while True:
+            with self.condition:
+                request, timeout = self.next_request()
+                if request is None:
+                    self.condition.wait(timeout)
+                    continue
+
+                now = time.monotonic()
+                if request.chat_id is not None and request.method not in UNMETERED:
+                    bucket = self.chat_bucket(request.chat_id)
+                    wait = bucket.wait()
+                    if wait > 0:
+                        self.push(request, now + wait)
+                        continue
+
+                    bucket.take()
+
+                if request.chat_id is not None and self.blocked.get(request.chat_id, 0) <= now:
+                    self.blocked.pop(request.chat_id, None)
+
+                wait = self.bucket.wait()
+                self.bucket.take()
+
+            # Global limit applies to everyone, just wait for it
+            time.sleep(wait)
+            self.executor.submit(self.execute, request)
+
+    def call_bot(self, request: Request) -> Any:
+        if request.attempts == 0:
+            metrics.telegram_wait.observe(time.monotonic() - request.submitted, 'bulk' if request.priority == BULK else 'interactive')
+
+        start = time.monotonic()
+        try:
+            return getattr(self.bot, request.method)(**request.kwargs)
+        except Exception as error:
+            metrics.telegram_errors.inc(request.method, type(error).__name__)
+            raise
+        finally:
+            metrics.telegram_seconds.observe(time.monotonic() - start, request.method)
+
+    def execute(self, request: Request):
+        try:
+            result = self.call_bot(request)
+
+        except RetryAfter as error:
+            logger.warning(f'Flood limit on {request.method} to {request.chat_id}, retrying in {error.retry_after}s')
+            with self.condition:
+                if request.chat_id is not None:
+                    self.chat_bucket(request.chat_id).pause(error.retry_after)
+                self.retry(request, error, error.retry_after)
+            return
+
+        except BadRequest as error:
+            # Subclass of NetworkError, but retrying won't help
+            with self.condition:
+                self.fail(request, error)
+            return
+
+        except NetworkError as error:
+            # A timed out send may have gone through, only retry what's safe to repeat
+            with self.condition:
+                if isinstance(error, TimedOut) and request.method.startswith('send_'):
+                    self.fail(request, error)
+                    return
+                self.retry(request, error, 2**request.attempts)
+            return
+
+        except Exception as error:
+            with self.condition:
+                self.fail(request, error)
+            return
+
+        with self.condition:
+            self.counts['sent'] += 1
+        request.future.set_result(result)
+
+    def retry(self, request: Request, error: Exception, delay: float):
+        request.attempts += 1
+        if request.attempts > self.retries:
+            self.fail(request, error)
+            return
+
+        self.counts['retried'] += 1
+        self.push(request, time.monotonic() + delay)
+        self.condition.notify()
+
+    def fail(self, request: Request, error: Exception):
+        self.counts['failed'] += 1
+        request.future.set_exception(error)
+
+
+if __name__ == '__main__':
+    print("You shouldn't be executing this")
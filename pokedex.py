@@ -0,0 +1,66 @@
+import config
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class Pokedex:
+    """Dex number -> name, from the bundled pokedex.json.
+
+    Names match what pypokedex (PokeAPI) returns. Numbers missing from the
+    table are looked up with pypokedex once and kept on a local cache file.
+    """
+
+    def __init__(self, path: str=config.dex_path, cache_path: str=config.dex_cache):
+        with open(path, encoding='utf-8') as file:
+            data = json.load(file)
+
+        self.version = data['version']
+        self.forms = frozenset(data['forms'])
+        # Index 0 is unused, so dex numbers can be used directly
+        self.names = tuple([None] + data['names'])
+
+        self.cache_path = cache_path
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, encoding='utf-8') as file:
+                self.cache = {int(number): name for number, name in json.load(file).items()}
+
+    def name(self, number: int) -> str:
+        if 0 < number < len(self.names):
+            return self.names[number]
+
+        if number not in self.cache:
+            self.cache[number] = self.fetch(number)
+            self.save()
+
+        return self.cache[number]
+
+    def fetch(self, number: int) -> str:
+        # Only imported when needed, it goes over the network
+        import pypokedex
+        logger.info(f'Dex number {number} not bundled, asking pypokedex')
+        return pypokedex.get(dex=number).name
+
+    def save(self):
+        with open(self.cache_path, 'w', encoding='utf-8') as file:
+            json.dump(self.cache, file, indent=4)
+
+    def reward(self, image: str) -> str:
+        # Image names are '<dex>' or '<dex>-<form>' for regional forms
+        number, _, form = image.partition('-')
+        if not number.isdigit():
+            return image.capitalize()
+
+        if form and form not in self.forms:
+            return image.capitalize()
+
+        name = self.name(int(number))
+        return f'{name}-{form}'.capitalize() if form else name.capitalize()
+
+
+if __name__ == '__main__':
+    print("You shouldn't be executing this")
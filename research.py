@@ -0,0 +1,69 @@
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.element import Tag
+from contextlib import suppress
+from pokedex import Pokedex
+
+
+# lxml is much faster than html.parser, but optional
+try:
+    import lxml
+    FEATURES = 'lxml'
+except ImportError:
+    FEATURES = 'html.parser'
+
+
+def find_wrapper(html: str, features: str=FEATURES) -> Tag:
+    # Only the tasks' subtree is built, the rest of the page is skipped
+    soup = BeautifulSoup(html, features, parse_only=SoupStrainer('div', id='taskGroupWraps'))
+    return soup.find('div', id='taskGroupWraps')
+
+
+def has_classes(element: Tag, classes: str) -> bool:
+    # Whole class names, 'cp' must not match 'cpWrap'
+    return set(classes.split()) <= set(element.get('class', []))
+
+
+def parse_reward(div: Tag, dex: Pokedex) -> (int, str, bool):
+    # Single pass over the reward's elements
+    image = None
+    cps = []
+    for element in div.find_all(['img', 'div']):
+        if element.name == 'img' and image is None:
+            image = element['src']
+        elif 'cp' in element.get('class', []):
+            cps.append(element)
+
+    cp = int(cps[1].find_all('p')[1].text.replace(",", ""))
+    reward = dex.reward(image.split('/')[-1].split('.')[0])
+    return cp, reward, 'shinyAvailable' in div['class']
+
+
+def parse_tasks(wrapper: Tag, dex: Pokedex) -> [tuple]:
+    # [(category, task, cps, rewards, shinys)], categories and tasks capitalized
+    scraped = []
+    for groupDiv in wrapper.find_all('div', recursive=False):
+        category = ' '.join(groupDiv.find().text.split(' ')[:-1]).capitalize()
+
+        for taskDiv in groupDiv.find_all('div', recursive=False):
+            if not has_classes(taskDiv, 'task unconfirmed pkmn'):
+                continue
+
+            with suppress(Exception):
+                task = taskDiv.find('p', {'class': 'taskText'}).text[:-1].capitalize()
+                rewardsWrap = taskDiv.find('div', {'class': 'taskRewardsWrap'})
+                rewards = [
+                    parse_reward(div, dex)
+                    for div in rewardsWrap.find_all('div', recursive=False)
+                    if has_classes(div, 'task-reward pokemon')
+                ]
+                if not rewards:
+                    continue
+
+                cps, names, shinys = (list(values) for values in zip(*rewards))
+                scraped.append((category, task, cps, names, shinys))
+
+    return scraped
+
+
+if __name__ == '__main__':
+    print("You shouldn't be executing this")
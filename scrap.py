@@ -1,10 +1,13 @@
-from bs4 import BeautifulSoup
+import catalog
 import config
-from contextlib import suppress
-from pymongo import MongoClient
-import pypokedex
-import re
+import hashlib
+import indexes
+import json
+from pokedex import Pokedex
+from pymongo import DeleteOne, InsertOne, MongoClient, UpdateOne
+import research
 from requests import get
+import sys
 
 
 if config.db_uri:
@@ -17,86 +20,165 @@ else:
         authSource=config.db_auth
     )
 database = client['bot']
+dex = Pokedex()
 
-#Translation check
-def translate(text: str, language: str = 'Español') -> str:
-    translation = database['translations'].find_one({'text': text}, {language: True})
-    if (translation is not None):
-        return translation[language]
-
-    else: 
-        translation = input(f"Traduce el siguiente texto: {text}\n")
-        database['translations'].insert_one({
-            'text': text,
-            language : translation
-        })
-        return translation
+#Translations, all loaded in one query and missing ones resolved in one batch
+def resolve_translations(texts: [str], language: str = 'Español') -> dict:
+    translations = {
+        document['text']: document[language]
+        for document in database['translations'].find({language: {'$exists': True}}, {'_id': False, 'text': True, language: True})
+    }
+    missing = sorted(set(texts) - set(translations))
+    if not missing:
+        return translations
+
+    resolved = {}
+    if config.translations_file:
+        with open(config.translations_file, encoding='utf-8') as file:
+            provided = json.load(file)
+        resolved = {text: provided[text] for text in missing if text in provided}
+
+    if resolved:
+        database['translations'].bulk_write([
+            UpdateOne({'text': text}, {'$set': {language: translation}}, upsert=True)
+            for text, translation in resolved.items()
+        ], ordered=False)
+        database['pending_translations'].delete_many({'text': {'$in': list(resolved)}})
+
+    #Whatever is left waits on pending_translations, shown untranslated meanwhile
+    pending = [text for text in missing if text not in resolved]
+    if pending:
+        database['pending_translations'].bulk_write([
+            UpdateOne({'text': text}, {'$set': {'language': language}}, upsert=True)
+            for text in pending
+        ], ordered=False)
+        print(f"{len(pending)} texts pending translation, add them to TRANSLATIONS_FILE:\n" + "\n".join(pending))
+
+    translations.update(resolved)
+    translations.update({text: text for text in pending})
+    return translations
+
+def task_key(document: dict) -> str:
+    #Identity of a task document, ignoring its _id
+    return json.dumps({key: value for key, value in document.items() if key != '_id'}, sort_keys=True, ensure_ascii=False)
+
+def apply_changes(collection: str, documents: [dict]) -> bool:
+    #Insert what's new and delete what's gone, returns whether anything changed
+    current = {}
+    for document in database[collection].find():
+        current.setdefault(task_key(document), []).append(document['_id'])
+    new = {task_key(document): document for document in documents}
+
+    operations = [InsertOne(document) for key, document in new.items() if key not in current]
+    for key, ids in current.items():
+        extra = ids if key not in new else ids[1:]
+        operations.extend(DeleteOne({'_id': id}) for id in extra)
+
+    if operations:
+        database[collection].bulk_write(operations, ordered=False)
+    return bool(operations)
+
+#Incremental mode only applies changes, and skips the run if nothing changed
+incremental = '--incremental' in sys.argv
+url = 'https://thesilphroad.com/research-tasks'
+previous = database['scrap_state'].find_one({'url': url}, {'_id': False}) or {}
+
+#Untranslated texts may have been provided since, those runs can't be skipped
+pending = database['pending_translations'].find_one({}, {'_id': True}) is not None
+skip_unchanged = incremental and not pending
+
+headers = {}
+if skip_unchanged and previous.get('etag'):
+    headers['If-None-Match'] = previous['etag']
+if skip_unchanged and previous.get('last_modified'):
+    headers['If-Modified-Since'] = previous['last_modified']
 
 #Get master div wrapper
-response = get('https://thesilphroad.com/research-tasks')
-soup = BeautifulSoup(response.text, 'html.parser')
-divWrapper = soup.find('div', {'id':'taskGroupWraps'})
-groupDivs = divWrapper.find_all('div', recursive=False)
-
-#Delete database
-database['tasks'].delete_many({})
-database['multi_tasks'].delete_many({})
-
-#Iterate over categories
-for groupDiv in groupDivs:  
-    category = groupDiv.find_all()[0]
-    category = ' '.join(category.text.split(' ')[:-1])
-    tasksDivs = groupDiv.find_all('div', {'class' : re.compile('.*task unconfirmed pkmn.*')}, recursive=False)
-
-    #Iterate over tasks
-    for taskDiv in tasksDivs:
-        with suppress(Exception):
-            task = taskDiv.find('p', {'class': 'taskText'}).text[:-1]
-            wrapper = taskDiv.find('div', {'class': 'taskRewardsWrap'})
-
-            #Iterate over rewards
-            rewardsDiv = wrapper.find_all('div', {'class' : re.compile('.*task-reward pokemon.*')}, recursive=False)
-            if(len(rewardsDiv) == 0): 
-                continue                        
-            cps = [int(div.find_all('div', class_='cp')[1].find_all('p')[1].text.replace(",","")) for div in rewardsDiv]
-            rewards = [
-                pypokedex.get(dex=int(div.find('img')['src'].split('/')[-1].split('.')[0])).name.capitalize() #convert from dexnumber to name
-                if '-' not in div.find('img')['src'].split('/')[-1].split('.')[0]    #this handles alolan/galarian forms
-                else div.find('img')['src'].split('/')[-1].split('.')[0].capitalize()  #this handles alolan/galarian forms
-                for div in rewardsDiv
-            ]
-            shinys = ['shinyAvailable' in div['class'] for div in rewardsDiv]
-
-            #Save rewards on database 
-            for (cp, reward, shiny) in zip(cps, rewards, shinys):
-                database['tasks'].insert_one({
-                    'cp' : cp,
-                    'shiny' : shiny,
-                    'event' : True if (category.lower() == 'event') else False,
-                    'English' : {
-                        'category' : category.capitalize(),
-                        'task' : task.capitalize(),
-                        'reward' : reward.capitalize()
-                    },
-                    'Español' : {
-                        'category' : translate(category.capitalize()),
-                        'task' : translate(task.capitalize()),
-                        'reward' : reward.capitalize()
-                    }
-                })            
-            if(len(cps) > 1):
-                database['multi_tasks'].insert_one({
-                    'shiny' : shinys,
-                    'event' : True if (category.lower() == 'event') else False,
-                    'English' : {
-                        'category' : category.capitalize(),
-                        'task' : task.capitalize(),
-                        'reward' : rewards
-                    },
-                    'Español' : {
-                        'category' : translate(category.capitalize()),
-                        'task' : translate(task.capitalize()),
-                        'reward' : rewards
-                    }
-                })
-    
+response = get(url, headers=headers)
+#Nothing to do isn't an error, cron jobs shouldn't report it as one
+if response.status_code == 304:
+    print("Research tasks not modified")
+    sys.exit(0)
+
+divWrapper = research.find_wrapper(response.text)
+
+state = {
+    'url': url,
+    'etag': response.headers.get('ETag'),
+    'last_modified': response.headers.get('Last-Modified'),
+    'hash': hashlib.sha256(str(divWrapper).encode()).hexdigest()
+}
+if skip_unchanged and state['hash'] == previous.get('hash'):
+    database['scrap_state'].update_one({'url': url}, {'$set': state}, upsert=True)
+    print("Research tasks unchanged")
+    sys.exit(0)
+
+#Documents are built in memory and published at the end
+scraped = research.parse_tasks(divWrapper, dex)
+tasks = []
+multi_tasks = []
+
+#Translate every category and task at once
+translations = resolve_translations([text for row in scraped for text in row[:2]])
+
+for (category, task, cps, rewards, shinys) in scraped:
+    #Save rewards
+    for (cp, reward, shiny) in zip(cps, rewards, shinys):
+        tasks.append({
+            'cp' : cp,
+            'shiny' : shiny,
+            'event' : True if (category.lower() == 'event') else False,
+            'English' : {
+                'category' : category,
+                'task' : task,
+                'reward' : reward.capitalize()
+            },
+            'Español' : {
+                'category' : translations[category],
+                'task' : translations[task],
+                'reward' : reward.capitalize()
+            }
+        })            
+    if(len(cps) > 1):
+        multi_tasks.append({
+            'shiny' : shinys,
+            'event' : True if (category.lower() == 'event') else False,
+            'English' : {
+                'category' : category,
+                'task' : task,
+                'reward' : rewards
+            },
+            'Español' : {
+                'category' : translations[category],
+                'task' : translations[task],
+                'reward' : rewards
+            }
+        })
+
+#Don't wipe the live catalog if the page couldn't be parsed
+if not tasks:
+    sys.exit("No tasks found, keeping the current ones")
+
+#Write staging collections and swap them in, readers never see a partial catalog
+changed = False
+if incremental:
+    for collection, documents in [('tasks', tasks), ('multi_tasks', multi_tasks)]:
+        changed = apply_changes(collection, documents) or changed
+
+else:
+    required = indexes.required_indexes(database)
+    for collection, documents in [('tasks', tasks), ('multi_tasks', multi_tasks)]:
+        staging = database[f'{collection}_staging']
+        staging.drop()
+        if documents:
+            staging.insert_many(documents)
+        indexes.create_indexes(staging, required[collection])
+        staging.rename(collection, dropTarget=True)
+    changed = True
+
+#Remember what was published, for the next incremental run
+database['scrap_state'].update_one({'url': url}, {'$set': state}, upsert=True)
+
+#Let running bots know the catalog changed
+if changed:
+    catalog.bump_version(database, 'tasks', 'multi_tasks')